@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+#
+# Benchmark suite for diff-by-regex.py.
+#
+# Generates reproducible synthetic file pairs (small/large files, many tiny
+# hunks, a few huge hunks, long lines, repetitive lines) and times the
+# end-to-end run (with a selective and a broad regex) as well as individual
+# functions (diff algorithms, map_order_lines, line_diff_spans, strip_diffs).
+#
+# usage: python3 bench-diff-by-regex.py [--scale F] [--repeat N] [--jobs N]
+#                                       [--filter REGEX] [--list]
+#                                       [--save FILE] [--compare FILE]
+#                                       [--threshold F]
+#
+# --save stores the results as a baseline (JSON), --compare compares the
+# results to a baseline and exits with status 1 if a benchmark got slower by
+# more than --threshold (default: 0.2, i.e. 20 %) and at least 5 ms.
+#
+# --check compares the line pairings of map_order_lines() on the hunks of all
+# cases to the ones of the original (quadratic) implementation instead and
+# exits with status 1 if they differ.
+#
+
+import difflib
+import functools
+import importlib.util
+import itertools
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import Counter
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "diff-by-regex.py")
+
+REGEXES = {
+    "selective": r"value=99\d{4}\b",  # ~1 % of the values
+    "broad": r"\d",
+}
+
+WORDS = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta",
+         "theta", "iota", "kappa", "lambda", "mu", "nu", "xi", "omicron"]
+
+
+def load_diff_by_regex():
+    """Import diff-by-regex.py (which is not a valid module name)."""
+    spec = importlib.util.spec_from_file_location("diff_by_regex", SCRIPT)
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = mod  # for pickling
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def text_line(rnd, i):
+    """Return a random line of text (with numbers for the regexes)."""
+    return "%s id=%u value=%u %s\n" % (
+        rnd.choice(WORDS), i, rnd.randrange(1000000), rnd.choice(WORDS))
+
+
+def modify_line(rnd, line):
+    """Return line with a random word or number changed."""
+    tokens = re.split(r"(\w+)", line)
+    i = rnd.randrange(1, len(tokens), 2)
+    tokens[i] = (str(rnd.randrange(1000000)) if tokens[i].isdigit()
+                 else rnd.choice(WORDS))
+    return "".join(tokens)
+
+
+def edit_lines(rnd, a, p, new_line):
+    """Return a copy of a where every line is modified, removed or followed by
+    an added line (new_line(i)) with probability p.
+    """
+    b = []
+    for (i, line) in enumerate(a):
+        r = rnd.random()
+        if r < (p / 3):
+            continue  # removed
+        elif r < (2 * p / 3):
+            b.append(modify_line(rnd, line))
+        else:
+            b.append(line)
+        if (p / 3 * 2) <= r < p:
+            b.append(new_line(i))  # added
+    return b
+
+
+def gen_scattered(nlines, p, seed=0):
+    """Generate two versions of a file of random text lines with scattered
+    edits (i.e. many small hunks).
+    """
+    rnd = random.Random(seed)
+    a = [text_line(rnd, i) for i in range(nlines)]
+    return (a, edit_lines(rnd, a, p, lambda i: text_line(rnd, i)))
+
+
+def gen_huge_hunks(nlines, nhunks, hunk_lines, seed=0):
+    """Generate two versions of a file with nhunks regions of hunk_lines lines
+    in which most lines have been edited.
+    """
+    rnd = random.Random(seed)
+    a = [text_line(rnd, i) for i in range(nlines)]
+    starts = sorted(rnd.sample(range(0, nlines - hunk_lines, hunk_lines),
+                               nhunks))
+
+    b, pos = [], 0
+    for start in starts:
+        b.extend(a[pos:start])
+        b.extend(edit_lines(rnd, a[start:(start + hunk_lines)], 0.9,
+                            lambda i: text_line(rnd, i)))
+        pos = start + hunk_lines
+    b.extend(a[pos:])
+    return (a, b)
+
+
+def gen_long_lines(nlines, width, seed=0):
+    """Generate two versions of a file with long lines (minified JSON-like
+    records), 10 % of which have a single field changed.
+    """
+    rnd = random.Random(seed)
+
+    def record(i):
+        return '{"id":%u,"name":"%s","value":%u}' % (
+            i, rnd.choice(WORDS), rnd.randrange(1000000))
+
+    a = []
+    for i in range(nlines):
+        records = [record(j) for j in range(width // 40)]
+        a.append("[%s]\n" % ",".join(records))
+
+    b = []
+    for line in a:
+        if rnd.random() < 0.1:
+            line = modify_line(rnd, line)
+        b.append(line)
+    return (a, b)
+
+
+def gen_repetitive(nlines, seed=0):
+    """Generate two versions of a file consisting of many repeated lines
+    (e.g. blank lines, braces, common keywords) with scattered edits.
+    """
+    rnd = random.Random(seed)
+    vocab = ["\n", "}\n", "{\n", "    return 0;\n", "    break;\n",
+             "</item>\n", "<item>\n", "# comment\n"]
+
+    a = []
+    for i in range(nlines):
+        if rnd.random() < 0.8:
+            a.append(rnd.choice(vocab))
+        else:
+            a.append("value_%u = %u\n" % (rnd.randrange(nlines), i))
+
+    b = []
+    for line in a:
+        r = rnd.random()
+        if r < 0.01:
+            continue  # removed
+        elif r < 0.02:
+            b.append(rnd.choice(vocab))  # added
+        elif r < 0.04:
+            line = line.replace("0", "1")  # modified
+        b.append(line)
+
+    return (a, b)
+
+
+# case name -> function(scale) returning (a, b)
+CASES = {
+    "small": lambda s: gen_scattered(max(100, int(1000 * s)), 0.02),
+    "large": lambda s: gen_scattered(int(200000 * s), 0.002),
+    "tiny-hunks": lambda s: gen_scattered(int(50000 * s), 0.05),
+    "huge-hunks": lambda s: gen_huge_hunks(int(20000 * s), 3,
+                                           max(100, int(2000 * s))),
+    "long-lines": lambda s: gen_long_lines(max(20, int(100 * s)), 4000),
+    "repetitive": lambda s: gen_repetitive(int(20000 * s)),
+}
+
+
+def reference_map_order_lines(dbr, lines_a, lines_b, cutoff_min=0.4):
+    """The original implementation of map_order_lines() (cf. --check)."""
+    def duplicate_values(m):
+        if not m:
+            return True
+        c = Counter((x for x in m.values() if x is not None))
+        if not c:
+            return True
+        return [v for v, c in c.items() if c > 1]
+
+    map_b = dbr.map_same_lines(lines_a, lines_b)
+    fixed_indices = tuple(map_b.values())
+
+    candidates_a = [l for i, l in enumerate(lines_a) if i not in fixed_indices]
+
+    cutoff = cutoff_min
+    while cutoff <= 1.0:
+        for line in [ln for ln in lines_b if map_b[ln] is None]:
+            try:
+                best_match = difflib.get_close_matches(
+                    line, candidates_a, n=1, cutoff=cutoff)[0]
+                map_b[line] = lines_a.index(best_match)
+            except IndexError:
+                # is added line
+                pass
+
+        duplicate_indices = duplicate_values(map_b)
+        if not duplicate_indices:
+            break
+
+        if cutoff < 1.0:
+            for k in [k for k, v in map_b.items() if v in duplicate_indices]:
+                map_b[k] = None
+            cutoff = min(1.0, cutoff * 1.1)
+            continue
+        else:
+            raise RuntimeError(
+                "failed to map lines uniquely (cutoff: %f)" % (cutoff))
+
+    res_a, res_b = list(lines_a), ([None] * len(lines_a))
+
+    for line, idx in map_b.items():
+        if idx is not None:
+            res_b[idx] = line
+
+    for pos, line in enumerate(map_b.keys()):
+        if map_b[line] is not None:
+            continue
+        i = min((i for i in map_b.values() if i is not None and i >= pos),
+                default=len(res_a))
+        res_a.insert(i, None)
+        res_b.insert(i, line)
+
+    return res_a, res_b
+
+
+def case_hunks(dbr, a, b):
+    """Return the hunks of the diff of a and b."""
+    return list(dbr.assemble_hunks(itertools.islice(
+        dbr.unified_diff(dbr.diff_matcher(a, b, "histogram")), 2, None)))
+
+
+def check_pairings(dbr, scale):
+    """Compare the line pairings of map_order_lines() to the ones of the
+    original implementation on the hunks of all cases, return the number of
+    hunks paired differently.
+    """
+    ndiffs = 0
+    for (case, gen) in CASES.items():
+        hunks = case_hunks(dbr, *gen(scale))
+        n = sum(
+            dbr.map_order_lines(hunk.lines_a, hunk.lines_b)
+            != reference_map_order_lines(dbr, hunk.lines_a, hunk.lines_b)
+            for hunk in hunks)
+        print("%-40s %5u of %5u hunks paired differently" % (
+            case, n, len(hunks)), flush=True)
+        ndiffs += n
+    return ndiffs
+
+
+def bench(func, repeat):
+    """Return the best wall time of repeat calls to func."""
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best
+
+
+def case_benchmarks(dbr, name, gen, scale, tmpdir, jobs):
+    """Yield (benchmark name, setup) for the benchmarks of a case. setup()
+    returns the function to time, the case is only generated (and written to
+    tmpdir) by the first setup().
+    """
+    path_a = os.path.join(tmpdir, name + ".a")
+    path_b = os.path.join(tmpdir, name + ".b")
+
+    @functools.lru_cache(maxsize=None)
+    def inputs():
+        (a, b) = gen(scale)
+        for (path, lines) in ((path_a, a), (path_b, b)):
+            with open(path, "w") as f:
+                f.writelines(lines)
+        return (a, b)
+
+    @functools.lru_cache(maxsize=None)
+    def hunks():
+        return case_hunks(dbr, *inputs())
+
+    @functools.lru_cache(maxsize=None)
+    def pairs():
+        pairs = []
+        for hunk in hunks():
+            pairs.extend(
+                (line_a, line_b) for (line_a, line_b) in zip(
+                    *dbr.map_order_lines(hunk.lines_a, hunk.lines_b))
+                if line_a is not None and line_b is not None
+                and line_a != line_b)
+        return pairs
+
+    for (re_name, regex) in REGEXES.items():
+        def setup(regex=regex):
+            inputs()
+            return lambda: subprocess.run(
+                [sys.executable, SCRIPT, "--no-cache", "-j", str(jobs),
+                 path_a, path_b, regex],
+                stdout=subprocess.DEVNULL, check=True)
+        yield ("%s/run:%s" % (name, re_name), setup)
+
+    for algorithm in dbr.DIFF_ALGORITHMS:
+        def setup(algorithm=algorithm):
+            (a, b) = inputs()
+            return lambda: list(dbr.unified_diff(
+                dbr.diff_matcher(a, b, algorithm)))
+        yield ("%s/diff:%s" % (name, algorithm), setup)
+
+    def setup():
+        hunks_ = hunks()
+        return lambda: [
+            dbr.map_order_lines(hunk.lines_a, hunk.lines_b)
+            for hunk in hunks_]
+    yield ("%s/map_order_lines" % (name), setup)
+
+    for mode in dbr.INTRALINE_DIFFS:
+        def setup(mode=mode):
+            pairs_ = pairs()
+            return lambda: [
+                dbr.intraline_diff_spans(line_a, line_b, mode)
+                for (line_a, line_b) in pairs_]
+        yield ("%s/line_diff_spans:%s" % (name, mode), setup)
+
+    def setup():
+        (hunks_, re_progs) = (hunks(), [
+            re.compile(regex) for regex in REGEXES.values()])
+        return lambda: [
+            dbr.strip_diffs(hunk.lines_a, hunk.lines_b, re_progs)
+            for hunk in hunks_]
+    yield ("%s/strip_diffs" % (name), setup)
+
+
+def compare(results, baseline, threshold, min_delta=0.005):
+    """Print results compared to baseline, return the names of the
+    benchmarks which got slower by more than threshold (and at least
+    min_delta seconds, to ignore the noise of very short benchmarks).
+    """
+    regressions = []
+    print()
+    print("%-40s %10s %10s %8s" % ("benchmark", "baseline", "current",
+                                   "ratio"))
+    for (name, t) in results.items():
+        if name not in baseline:
+            print("%-40s %10s %10.3f" % (name, "-", t))
+            continue
+        ratio = t / baseline[name] if baseline[name] else float("inf")
+        mark = ""
+        if ratio > (1 + threshold) and (t - baseline[name]) >= min_delta:
+            regressions.append(name)
+            mark = "  REGRESSION"
+        print("%-40s %10.3f %10.3f %8.2f%s" % (
+            name, baseline[name], t, ratio, mark))
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="bench-diff-by-regex.py")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="scale the sizes of the inputs")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="worker processes for the end-to-end runs")
+    parser.add_argument("--filter", metavar="REGEX",
+                        help="only run the benchmarks matching REGEX")
+    parser.add_argument("--list", action="store_true", default=False,
+                        help="list the benchmarks instead of running them")
+    parser.add_argument("--save", metavar="FILE",
+                        help="save the results as baseline to FILE")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare the results to the baseline in FILE")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--check", action="store_true", default=False,
+                        help="compare the line pairings to the original "
+                        "implementation instead of running the benchmarks")
+    options = parser.parse_args()
+
+    dbr = load_diff_by_regex()
+    if options.check:
+        sys.exit(1 if check_pairings(dbr, options.scale) else 0)
+    re_filter = re.compile(options.filter or "")
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if not options.list:
+            print("%-40s %10s" % ("benchmark", "time [s]"))
+        for (case, gen) in CASES.items():
+            for (name, setup) in case_benchmarks(
+                    dbr, case, gen, options.scale, tmpdir, options.jobs):
+                if not re_filter.search(name):
+                    continue
+                if options.list:
+                    print(name)
+                    continue
+                results[name] = bench(setup(), options.repeat)
+                print("%-40s %10.3f" % (name, results[name]), flush=True)
+
+    if options.save:
+        with open(options.save, "w") as f:
+            json.dump({"scale": options.scale, "results": results}, f,
+                      indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("scale") != options.scale:
+            print("warning: baseline has been measured with --scale %s" % (
+                baseline.get("scale")), file=sys.stderr)
+        if compare(results, baseline["results"], options.threshold):
+            sys.exit(1)
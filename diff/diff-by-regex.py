@@ -4,26 +4,117 @@
 # overlaps with a regex match.
 # Added/removed lines are ignored.
 #
-# usage: python3 diff-by-regex.py file1 file2 regex
+# usage: python3 diff-by-regex.py [--stream | --parallel-diff] [--algorithm ALGO]
+#                                 [--jobs N] file1 file2 regex
+#        python3 diff-by-regex.py [--jobs N] --from-diff DIFF regex
+#        python3 diff-by-regex.py [-o TEMPLATE] -e NAME=REGEX [-e ...]
+#                                 file1 file2
+#
+# --stream reads the input files incrementally instead of loading them into
+# memory completely, so that multi-GB files can be processed.
+#
+# --parallel-diff cuts the input files at lines they have in common and diffs
+# the segments in parallel.
+#
+# --algorithm selects the line diff algorithm: difflib (default), myers,
+# patience or histogram.
+#
+# --jobs sets the number of worker processes (default: number of CPUs).
+#
+# If file1 and file2 are directories, the files in both directory trees are
+# paired by their relative paths and diffed (files which exist only in one of
+# the trees are diffed against an empty file).
+#
+# --intraline token compares modified lines by words and punctuation instead of
+# characters (faster for long lines), lines longer than --max-line-length are
+# considered to be changed completely.
+#
+# --bytes processes the files as bytes: they are memory-mapped and not decoded,
+# so that files with mixed or invalid encodings can be diffed.
+#
+# --from-diff reads an existing unified diff (e.g. from "git diff" or
+# "diff -u") instead of computing it.
+#
+# With -e, the diff is filtered by multiple named regexes at once (the files
+# are diffed and the lines are mapped only once). The filtered diffs are
+# written to the files given by -o (e.g. "out-{name}.diff") or to stdout, where
+# every line is prefixed with "NAME:".
+#
+# --stats prints the time spent per stage (incl. the workers) and counters
+# (hunks, lines, IPC bytes, worker utilisation, ...) to stderr, --stats-json
+# writes them to a file.
+#
+# The filtered hunks are cached in ~/.cache/diff-by-regex (cf. --cache-dir,
+# --cache-size), so that reruns only need to filter the hunks which changed.
+# --no-cache disables and --clear-cache clears the cache.
 #
 
+import bisect
+import collections
+import contextlib
 import difflib
+import functools
+import hashlib
+import itertools
+import mmap
+import os
+import pickle
 import re
+import stat
 import sys
+import time
 
 from collections import (OrderedDict, Counter)
 
 
+# Lines of the input files (a, b), if they have been read completely.
+# Worker processes inherit them (fork), so that only line ranges need to be
+# sent to them.
+SHARED_LINES = None
+
+# Stats of this process if --stats is enabled (cf. Stats), None otherwise.
+STATS = None
+
+
+def diff_literal(s, like):
+    """Return the str s as bytes if like is bytes (cf. --bytes), so that diff
+    lines of the same type as the input lines can be constructed.
+    """
+    return os.fsencode(s) if isinstance(like, bytes) else s
+
+
+@contextlib.contextmanager
+def read_lines(f):
+    """Context manager returning an iterator over the lines of the binary file
+    f (the lines are bytes, nothing is decoded).
+
+    Regular files are memory-mapped instead of read, the mapping is closed on
+    exit. Other files (pipes, FIFOs) and files which cannot be mapped (e.g.
+    empty ones) are iterated as they are.
+    """
+    m = None
+    if stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            pass
+    if m is None:
+        yield iter(f)
+        return
+    with m:
+        yield iter(m.readline, b"")
+
+
 class Hunk:
     """Class to represent a raw diff hunk (i.e. a range line and two sets of
     lines (before and after)).
     """
-    __slots__ = ("range", "lines_a", "lines_b")
+    __slots__ = ("range", "lines_a", "lines_b", "matches", "cached")
 
     class Range:
         """Structured representation of a range line ("@@ ... @@")."""
         __re_range = re.compile(
-            r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@$")
+            r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@(?: .*)?$")
         __slots__ = ("a_begin", "a_lines", "b_begin", "b_lines")
 
         def __init__(self, a_begin, a_lines, b_begin, b_lines):
@@ -34,7 +125,9 @@ class Hunk:
 
         @classmethod
         def fromstr(cls, s):
-            """New Range from a range line string."""
+            """New Range from a range line string (or bytes)."""
+            if isinstance(s, bytes):
+                s = s.decode("latin-1")
             matches = cls.__re_range.match(s.rstrip("\n"))
             return cls(
                 int(matches.group(1)), int(matches.group(2) or 1),
@@ -55,6 +148,17 @@ class Hunk:
         self.range = self.Range.fromstr(range_str)
         self.lines_a = []
         self.lines_b = []
+        self.matches = None  # per regex, cf. scan_matches()
+        self.cached = None  # cf. HunkCache
+
+    def load_lines(self, a, b):
+        """Set lines_a and lines_b from the lines of the complete files a and b
+        (according to range).
+        """
+        r = self.range
+        self.matches = None
+        self.lines_a = a[(r.a_begin - 1):(r.a_begin - 1 + r.a_lines)]
+        self.lines_b = b[(r.b_begin - 1):(r.b_begin - 1 + r.b_lines)]
 
     def append_line(self, diffline):
         """Append a line of diff output to this Hunk.
@@ -63,9 +167,10 @@ class Hunk:
         "+" lines to lines_b
         " " lines (context) are appended to both.
         """
-        if diffline.startswith("-"):
+        c = diffline[:1]
+        if c in ("-", b"-"):
             self.lines_a.append(diffline[1:])
-        elif diffline.startswith("+"):
+        elif c in ("+", b"+"):
             self.lines_b.append(diffline[1:])
         else:
             self.lines_a.append(diffline[1:])
@@ -79,6 +184,11 @@ def is_junk(c):
     return c in " \t\r\n"
 
 
+def is_junk_byte(c):
+    """Like is_junk(), but for bytes (i.e. c is an int)."""
+    return c in b" \t\r\n"
+
+
 def overlaps(a, b):
     """Return True if the span a = (start, end) overlaps with b = (start, end),
     otherwise False.
@@ -89,37 +199,52 @@ def overlaps(a, b):
         or (b[1]-1 >= a[0] and b[1]-1 <= a[1]-1)
 
 
-def diff_overlaps_regex(line, re_prog, diff_spans):
-    """Return the diff spans that overlap with a match of re_prog in line."""
-    res, pos = [], 0
+def span_bounds(span):
+    """Return the (first, last) positions overlaps() considers for span."""
+    return (min(span[0], span[1]-1), max(span[0], span[1]-1))
 
-    while True:
-        m = re_prog.search(line, pos)
-        if m is None:
-            break
-        re_span = m.span(0)[0:2]
 
-        for i, ds in ((i, ds) for i, ds in enumerate(diff_spans) if ds is not None):
+def diff_overlaps_regex(line, re_prog, diff_spans, re_spans=None):
+    """Return the diff spans that overlap with a match of re_prog in line.
+
+    re_spans are the spans of the matches of re_prog in line, they are
+    searched for if not given.
+    """
+    if re_spans is None:
+        re_spans = [m.span(0) for m in re_prog.finditer(line)]
+    res, j = [], 0
+
+    # Both diff_spans and re_spans are sorted and do not overlap themselves,
+    # so the matches a diff span overlaps with can be found by sweeping.
+    for i, ds in enumerate(diff_spans):
+        ds_first, ds_last = span_bounds(ds)
+        while j < len(re_spans) and span_bounds(re_spans[j])[1] < ds_first:
+            j += 1
+
+        for k in range(j, len(re_spans)):
+            re_span = re_spans[k]
+            if span_bounds(re_span)[0] > ds_last:
+                break
             if overlaps(ds, re_span):
                 res.append((i, ds))
                 # only take the part of range that match regex
                 # FIXME
                 # res.append((i, (max(ds[0], re_span[0]), min(ds[1], re_span[1]))))
-        pos = re_span[1]
+                break
 
     return res
 
 
-def duplicate_values(m):
-    """Return the keys of m if the value assigned to it occurs more than once
-    in the dict.
+def scan_matches(re_prog, lines):
+    """Return a dict mapping every line in lines which contains a match of
+    re_prog to the list of spans of the matches.
     """
-    if not m:
-        return True
-    c = Counter((x for x in m.values() if x is not None))
-    if not c:
-        return True
-    return [v for v, c in c.items() if c > 1]
+    res = {}
+    for line in set(lines):
+        spans = [m.span(0) for m in re_prog.finditer(line)]
+        if spans:
+            res[line] = spans
+    return res
 
 
 def map_same_lines(lines_a, lines_b):
@@ -145,48 +270,132 @@ def map_same_lines(lines_a, lines_b):
     return map_b
 
 
+def line_ngrams(line, q=3):
+    """Return the set of character q-grams of line (padded, so that short
+    lines have q-grams, too).
+    """
+    pad = diff_literal("\0", line) * (q - 1)
+    line = pad + line + pad
+    return {line[i:(i + q)] for i in range(len(line) - q + 1)}
+
+
+def best_matches(lines_a, candidates_a, lines_b, cutoff, k=16, q=3):
+    """Find the most similar line of lines_a (restricted to the indices in
+    candidates_a) for every line of lines_b.
+
+    Returns a dict mapping indices in lines_b to (ratio, line of lines_a) if
+    the similarity (as used by difflib.get_close_matches()) is >= cutoff.
+    Ties are broken like get_close_matches() does (greatest line wins).
+
+    The k candidates sharing the most character q-grams with a line (looked
+    up in an inverted index) are compared to it first. q-grams occurring in
+    many lines are ignored unless the line has no other matches. The other
+    candidates can then mostly be skipped using the upper bounds of their
+    similarity (real_quick_ratio(), quick_ratio()).
+    """
+    index = collections.defaultdict(list)
+    if len(candidates_a) > k:
+        for i in candidates_a:
+            for g in line_ngrams(lines_a[i], q):
+                index[g].append(i)
+    max_postings = max(k, (len(candidates_a) // 4))
+
+    s = difflib.SequenceMatcher()
+    compared, ratios = 0, 0
+    best = {}
+    for (bi, line) in enumerate(lines_b):
+        if len(candidates_a) <= k:
+            candidates = candidates_a
+        else:
+            postings = [index[g] for g in line_ngrams(line, q) if g in index]
+            shared = Counter()
+            for p in postings:
+                if len(p) <= max_postings:
+                    shared.update(p)
+            if not shared:
+                for p in postings:
+                    shared.update(p)
+            candidates = itertools.chain(
+                (i for (i, _) in shared.most_common(k)), candidates_a)
+
+        s.set_seq2(line)
+        match = None
+        for ai in candidates:
+            threshold = cutoff if match is None else match[0]
+            s.set_seq1(lines_a[ai])
+            compared += 1
+            if s.real_quick_ratio() >= threshold \
+                    and s.quick_ratio() >= threshold:
+                ratios += 1
+                ratio = s.ratio()
+                if ratio >= threshold \
+                        and (match is None or (ratio, lines_a[ai]) > match):
+                    match = (ratio, lines_a[ai])
+        if match is not None:
+            best[bi] = match
+
+    if STATS is not None:
+        STATS.counters["line pairs compared"] += compared
+        STATS.counters["line pair ratios computed"] += ratios
+
+    return best
+
+
 def map_order_lines(lines_a, lines_b, cutoff_min=0.4):
     """Map lines_a and lines_b using similarity.
 
+    Every line of lines_b is paired with its most similar line of lines_a
+    (cf. best_matches()) if their similarity is >= the cutoff. Lines
+    competing for the same line of lines_a are unpaired and the cutoff is
+    raised (by 10 % per round, starting at cutoff_min) until they are paired
+    without conflicts, the remaining lines are not paired.
+
     Returns two lists of same length.
     """
     map_b = map_same_lines(lines_a, lines_b)
-    fixed_indices = tuple(map_b.values())
+    fixed_indices = set(map_b.values())
 
-    candidates_a = [l for i, l in enumerate(lines_a) if i not in fixed_indices]
+    candidates_a = [i for i in range(len(lines_a)) if i not in fixed_indices]
 
-    cutoff = cutoff_min
-    while cutoff <= 1.0:
-        for line in [ln for ln in lines_b if map_b[ln] is None]:
-            try:
-                best_match = difflib.get_close_matches(
-                    line, candidates_a, n=1, cutoff=cutoff)[0]
-                map_b[line] = lines_a.index(best_match)
-            except IndexError:
-                # is added line
-                pass
+    # the best match of the lines of lines_b, (ratio, index in lines_a) or
+    # None, ties are broken like by difflib.get_close_matches() (the greatest
+    # line, its first index in lines_a)
+    first_index = {}
+    for (i, line) in enumerate(lines_a):
+        first_index.setdefault(line, i)
+    best = {}
 
-        duplicate_indices = duplicate_values(map_b)
-        if not duplicate_indices:
-            # all lines could be mapped without conflicts
-            break
+    def find_best(lines):
+        found = best_matches(lines_a, candidates_a, lines, cutoff_min)
+        for (bi, line) in enumerate(lines):
+            match = found.get(bi)
+            best[line] = match and (match[0], first_index[match[1]])
 
-        if cutoff < 1.0:
-            # we can try again using a greater cutoff
+    find_best([ln for ln in map_b if map_b[ln] is None])
 
-            for k in [k for k, v in map_b.items() if v in duplicate_indices]:
-                map_b[k] = None
-
-            cutoff = min(1.0, cutoff * 1.1)
-            continue
-        else:
-            # cannot uniquely map lines
+    cutoff = cutoff_min
+    while True:
+        unmapped = [ln for ln in map_b if map_b[ln] is None]
+        # lines unpaired because of a conflict (which can involve the
+        # context lines) have not been looked up yet
+        find_best([ln for ln in unmapped if ln not in best])
+        for line in unmapped:
+            if best[line] is not None and best[line][0] >= cutoff:
+                map_b[line] = best[line][1]
+
+        counts = Counter(i for i in map_b.values() if i is not None)
+        duplicate_indices = {i for (i, n) in counts.items() if n > 1}
+        if not duplicate_indices:
+            break
+        if cutoff >= 1.0:
             raise RuntimeError(
                 "failed to map lines uniquely (cutoff: %f)" % (cutoff),
-                "lines_a:\n" + "".join(
-                    "%u:%s" % x for x in enumerate(lines_a)),
-                "lines_a[i]->line_b:\n" + "".join(
-                    "%s:%s" % (v, k) for (k, v) in map_b.items()))
+                [ln for ln in map_b if map_b[ln] in duplicate_indices])
+
+        for line in map_b:
+            if map_b[line] in duplicate_indices:
+                map_b[line] = None
+        cutoff = min(1.0, cutoff * 1.1)
 
     # Construct result lists.
     res_a, res_b = list(lines_a), ([None] * len(lines_a))
@@ -195,11 +404,13 @@ def map_order_lines(lines_a, lines_b, cutoff_min=0.4):
         if idx is not None:
             res_b[idx] = line
 
+    mapped_indices = sorted(i for i in map_b.values() if i is not None)
     for pos, line in enumerate(map_b.keys()):
         if map_b[line] is not None:
             continue
-        i = min((i for i in map_b.values() if i is not None and i >= pos),
-                default=len(res_a))
+        # insert before the first mapped line at or after pos
+        i = bisect.bisect_left(mapped_indices, pos)
+        i = mapped_indices[i] if i < len(mapped_indices) else len(res_a)
         res_a.insert(i, None)
         res_b.insert(i, line)
 
@@ -233,7 +444,9 @@ def line_mod_regex(line_a, line_b, a_diff, b_diff, overlap_spans_a, overlap_span
 def line_diff_spans(line_a, line_b):
     """Return spans for differences between line_a and line_b."""
     # Find areas of line that differ
-    matcher = difflib.SequenceMatcher(is_junk, line_a, line_b, autojunk=False)
+    matcher = difflib.SequenceMatcher(
+        (is_junk_byte if isinstance(line_a, bytes) else is_junk),
+        line_a, line_b, autojunk=False)
     blocks = matcher.get_matching_blocks()
 
     a_diff, a_pos = [], 0
@@ -258,49 +471,150 @@ def line_diff_spans(line_a, line_b):
     return a_diff, b_diff
 
 
-def strip_diff(lines_a, lines_b, re_prog):
+# Word, whitespace and punctuation tokens (cf. line_token_diff_spans())
+TOKEN_RE = re.compile(r"\w+|\s+|[^\w\s]")
+TOKEN_RE_BYTES = re.compile(rb"\w+|\s+|[^\w\s]")
+
+
+def line_token_diff_spans(line_a, line_b):
+    """Like line_diff_spans(), but the lines are compared by tokens (cf.
+    TOKEN_RE) instead of characters.
+
+    The tokens are diffed using histogram_split(), which copes with the
+    many repeated tokens (e.g. punctuation) of long lines much better than
+    difflib.SequenceMatcher.
+    """
+    if isinstance(line_a, bytes):
+        token_re, nl = TOKEN_RE_BYTES, b"\n"
+    else:
+        token_re, nl = TOKEN_RE, "\n"
+    tokens_a = token_re.findall(line_a.rstrip(nl))
+    tokens_b = token_re.findall(line_b.rstrip(nl))
+
+    # character offsets of the tokens
+    offsets_a = list(itertools.accumulate(map(len, tokens_a), initial=0))
+    offsets_b = list(itertools.accumulate(map(len, tokens_b), initial=0))
+
+    a_diff, a_pos = [], 0
+    b_diff, b_pos = [], 0
+
+    for (i, j, size) in diff_blocks(tokens_a, tokens_b, histogram_split):
+        if i > a_pos or j > b_pos:
+            a_diff.append((offsets_a[a_pos], offsets_a[i]))
+            b_diff.append((offsets_b[b_pos], offsets_b[j]))
+
+        a_pos = i + size
+        b_pos = j + size
+
+    return a_diff, b_diff
+
+
+def line_whole_diff_spans(line_a, line_b):
+    """Return spans which cover line_a and line_b completely (apart from a
+    common line ending), i.e. treat the whole line as changed.
+    """
+    nl = diff_literal("\n", line_a)
+    n = 1 if (line_a.endswith(nl) and line_b.endswith(nl)) else 0
+    return [(0, len(line_a) - n)], [(0, len(line_b) - n)]
+
+
+INTRALINE_DIFFS = {
+    "char": line_diff_spans,
+    "token": line_token_diff_spans,
+}
+
+
+def intraline_diff_spans(line_a, line_b, mode="char", max_length=10000):
+    """Return spans for differences between line_a and line_b using the
+    INTRALINE_DIFFS function mode.
+
+    If one of the lines is longer than max_length characters, the whole lines
+    are considered to differ.
+    """
+    if len(line_a) > max_length or len(line_b) > max_length:
+        return line_whole_diff_spans(line_a, line_b)
+    return INTRALINE_DIFFS[mode](line_a, line_b)
+
+
+def strip_diffs(lines_a, lines_b, re_progs, matches=None,
+                diff_spans_func=line_diff_spans):
     """Order lines in lines_a and lines_b (of a single hunk) and construct a
-    diff that only takes changes overlapping with a regular expression.
+    diff for each regular expression in re_progs that only takes changes
+    overlapping with it.
+
+    The lines are mapped and the differences of a pair of lines are searched
+    for only once for all regular expressions.
+
+    matches are the matches of each of re_progs in the lines as returned by
+    scan_matches(), they are searched for if not given.
+
+    diff_spans_func returns the differences of a pair of lines (cf.
+    intraline_diff_spans()).
 
-    Yields diff lines.
+    Returns a list of diff lines for each regular expression.
     """
-    for line_a, line_b in zip(*map_order_lines(lines_a, lines_b)):
-        # Handle removes and adds
+    if matches is None:
+        matches = [scan_matches(re_prog, itertools.chain(lines_a, lines_b))
+                   for re_prog in re_progs]
+    results = [[] for _ in re_progs]
+    minus, plus, space = (
+        diff_literal(c, (lines_a or lines_b)[0]) for c in ("-", "+", " "))
+
+    for line_a, line_b in zip(*timed(
+            "map_order_lines", map_order_lines, lines_a, lines_b)):
+        # Handle removes, adds and context lines
         if line_a is None:
-            yield ("+" + line_b)
-            continue
-        if line_b is None:
-            yield ("-" + line_a)
-            # yield (" " + line_a)
+            diffline = (plus + line_b)
+        elif line_b is None:
+            diffline = (minus + line_a)
+        elif line_a == line_b:
+            diffline = (space + line_a)
+        else:
+            diffline = None
+        if diffline is not None:
+            for res in results:
+                res.append(diffline)
             continue
 
-        if line_a is not line_b:  # ref. equality
-            a_diff, b_diff = line_diff_spans(line_a, line_b)
+        diff_spans = None
+        for (re_prog, re_matches, res) in zip(re_progs, matches, results):
+            re_spans_a = re_matches.get(line_a, ())
+            re_spans_b = re_matches.get(line_b, ())
+            if not (re_spans_a or re_spans_b):
+                # no match, no need to look for differences
+                res.append(space + line_b)
+                continue
+
+            if diff_spans is None:
+                diff_spans = timed(
+                    "line_diff_spans", diff_spans_func, line_a, line_b)
+            a_diff, b_diff = diff_spans
 
             # Test if any of the differing areas overlap with regex
-            overlap_spans_a = diff_overlaps_regex(line_a, re_prog, a_diff)
-            overlap_spans_b = diff_overlaps_regex(line_b, re_prog, b_diff)
+            overlap_spans_a = diff_overlaps_regex(
+                line_a, re_prog, a_diff, re_spans_a)
+            overlap_spans_b = diff_overlaps_regex(
+                line_b, re_prog, b_diff, re_spans_b)
 
             if overlap_spans_a or overlap_spans_b:
                 # yes: keep change
-                yield ("-" + line_a)
-                yield ("+" + line_mod_regex(
+                res.append(minus + line_a)
+                res.append(plus + line_mod_regex(
                     line_a, line_b,
                     a_diff, b_diff,
                     overlap_spans_a, overlap_spans_b))
             else:
                 # no: keep "original" line
-                yield (" " + line_b)
-        else:
-            # context line
-            yield (" " + line_a)
+                res.append(space + line_b)
+
+    return results
 
 
 def assemble_hunks(udiff_lines):
     """Read lines from difflib generator and yields Hunk objects."""
     hunk = None
     for diffline in udiff_lines:
-        if diffline.startswith("@@"):
+        if diffline[:2] in ("@@", b"@@"):
             if hunk:  # not on first hunk
                 yield hunk
 
@@ -314,54 +628,1347 @@ def assemble_hunks(udiff_lines):
             yield hunk
 
 
-def process_hunk(re_prog, hunk):
+class PushbackIterator:
+    """Iterator wrapper which allows to "unread" items."""
+    __slots__ = ("_it", "_pending")
+
+    def __init__(self, iterable):
+        self._it = iter(iterable)
+        self._pending = collections.deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._pending:
+            return self._pending.popleft()
+        return next(self._it)
+
+    def unread(self, items):
+        """Push back items so that they are returned (in order) by the next
+        calls to next().
+        """
+        self._pending.extendleft(reversed(items))
+
+
+def find_anchor(ra, rb, buf_a, buf_b, k):
+    """Read lines from ra and rb (alternating) and append them to buf_a and
+    buf_b, respectively, until a run of k lines common to both buffers is
+    found.
+
+    Returns the indices (into buf_a and buf_b) of the first line of the run
+    or None if EOF was reached on both inputs before a run was found.
+    """
+    pos_a = collections.defaultdict(list)
+    pos_b = collections.defaultdict(list)
+    runs = {}  # diagonal (i - j) -> (last i, run length)
+
+    def add(line, buf, pos_own, pos_other, is_a):
+        i = len(buf)
+        buf.append(line)
+        pos_own[line].append(i)
+
+        # Pairs on a diagonal are seen in increasing order, because both
+        # buffers only grow.
+        for j in pos_other.get(line, ()):
+            ia, ib = (i, j) if is_a else (j, i)
+            last, length = runs.get(ia - ib, (None, 0))
+            length = (length + 1) if last == (ia - 1) else 1
+            runs[ia - ib] = (ia, length)
+            if length >= k:
+                return (ia - k + 1, ib - k + 1)
+        return None
+
+    eof_a = eof_b = False
+    while not (eof_a and eof_b):
+        if not eof_a:
+            line = next(ra, None)
+            if line is None:
+                eof_a = True
+            else:
+                anchor = add(line, buf_a, pos_a, pos_b, True)
+                if anchor:
+                    return anchor
+        if not eof_b:
+            line = next(rb, None)
+            if line is None:
+                eof_b = True
+            else:
+                anchor = add(line, buf_b, pos_b, pos_a, False)
+                if anchor:
+                    return anchor
+    return None
+
+
+class BlocksMatcher(difflib.SequenceMatcher):
+    """difflib.SequenceMatcher which uses a precomputed list of matching
+    blocks instead of computing them itself.
+    """
+
+    def __init__(self, a, b, blocks):
+        super().__init__(None, (), ())
+        self.a, self.b = a, b
+        self._blocks = blocks
+
+    def get_matching_blocks(self):
+        return self._blocks
+
+
+def unified_diff(matcher, fromfile="", tofile="", n=3, offsets=(0, 0)):
+    """Like difflib.unified_diff(), but uses the opcodes of the given matcher.
+
+    offsets are added to the line numbers in the range lines.
+    """
+    a, b = matcher.a, matcher.b
+    started = False
+
+    for group in matcher.get_grouped_opcodes(n):
+        if not started:
+            like = (a or b)[0]
+            minus, plus, space = (
+                diff_literal(c, like) for c in ("-", "+", " "))
+            yield diff_literal("--- %s\n" % (fromfile), like)
+            yield diff_literal("+++ %s\n" % (tofile), like)
+            started = True
+
+        first, last = group[0], group[-1]
+        a_lines, b_lines = (last[2] - first[1]), (last[4] - first[3])
+        yield diff_literal(str(Hunk.Range(
+            (offsets[0] + first[1] + bool(a_lines)), a_lines,
+            (offsets[1] + first[3] + bool(b_lines)), b_lines)), like)
+
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                for line in a[i1:i2]:
+                    yield space + line
+                continue
+            if tag in ("replace", "delete"):
+                for line in a[i1:i2]:
+                    yield minus + line
+            if tag in ("replace", "insert"):
+                for line in b[j1:j2]:
+                    yield plus + line
+
+
+def merge_blocks(blocks):
+    """Merge adjacent matching blocks and drop empty ones (incl. the
+    sentinel).
+    """
+    res = []
+    for (i, j, size) in blocks:
+        if res and (res[-1][0] + res[-1][2]) == i \
+                and (res[-1][1] + res[-1][2]) == j:
+            res[-1] = (res[-1][0], res[-1][1], (res[-1][2] + size))
+        elif size:
+            res.append((i, j, size))
+    return res
+
+
+def intern_lines(a, b):
+    """Map the lines of a and b to integers (equal lines get the same number),
+    so that comparisons are cheap.
+    """
+    ids = {}
+    return ([ids.setdefault(x, len(ids)) for x in a],
+            [ids.setdefault(x, len(ids)) for x in b])
+
+
+def diff_blocks(a, b, split):
+    """Compute the matching blocks of a and b (like
+    difflib.SequenceMatcher.get_matching_blocks()).
+
+    The common prefix and suffix of each range is matched directly, the rest
+    of the range is passed to split(A, B, a0, a1, b0, b1), which returns a
+    list of sub-ranges to diff and a list of matching blocks it found.
+    """
+    A, B = intern_lines(a, b)
+    blocks = []
+    todo = [(0, len(A), 0, len(B))]
+
+    while todo:
+        a0, a1, b0, b1 = todo.pop()
+
+        n = 0
+        while (a0 + n) < a1 and (b0 + n) < b1 and A[a0 + n] == B[b0 + n]:
+            n += 1
+        if n:
+            blocks.append((a0, b0, n))
+            a0, b0 = (a0 + n), (b0 + n)
+
+        n = 0
+        while (a1 - n) > a0 and (b1 - n) > b0 \
+                and A[a1 - n - 1] == B[b1 - n - 1]:
+            n += 1
+        if n:
+            blocks.append(((a1 - n), (b1 - n), n))
+            a1, b1 = (a1 - n), (b1 - n)
+
+        if a0 == a1 or b0 == b1:
+            continue
+
+        ranges, matched = split(A, B, a0, a1, b0, b1)
+        todo.extend(ranges)
+        blocks.extend(matched)
+
+    blocks.sort()
+    res = merge_blocks(blocks)
+    res.append((len(a), len(b), 0))
+    return res
+
+
+def myers_split(A, B, a0, a1, b0, b1):
+    """Split the ranges at the middle snake of an optimal edit script
+    (Myers' linear space O(ND) algorithm).
+    """
+    N, M = (a1 - a0), (b1 - b0)
+    max_d = (N + M + 1) // 2
+    v_off = max_d
+    v1 = [-1] * (2 * max_d + 2)
+    v2 = [-1] * (2 * max_d + 2)
+    v1[v_off + 1] = v2[v_off + 1] = 0
+    delta = N - M
+    front = bool(delta % 2)
+    k1start, k1end, k2start, k2end = 0, 0, 0, 0
+
+    def _split(x, y):
+        if (x, y) in ((0, 0), (N, M)):
+            return ([], [])
+        return ([(a0, (a0 + x), b0, (b0 + y)),
+                 ((a0 + x), a1, (b0 + y), b1)], [])
+
+    for d in range(max_d):
+        # forward path
+        for k1 in range((k1start - d), (d + 1 - k1end), 2):
+            k1_off = v_off + k1
+            if k1 == -d or (k1 != d and v1[k1_off - 1] < v1[k1_off + 1]):
+                x1 = v1[k1_off + 1]
+            else:
+                x1 = v1[k1_off - 1] + 1
+            y1 = x1 - k1
+            while x1 < N and y1 < M and A[a0 + x1] == B[b0 + y1]:
+                x1 += 1
+                y1 += 1
+            v1[k1_off] = x1
+            if x1 > N:
+                k1end += 2
+            elif y1 > M:
+                k1start += 2
+            elif front:
+                k2_off = v_off + delta - k1
+                if 0 <= k2_off < len(v2) and v2[k2_off] != -1:
+                    if x1 >= (N - v2[k2_off]):
+                        return _split(x1, y1)
+
+        # reverse path
+        for k2 in range((k2start - d), (d + 1 - k2end), 2):
+            k2_off = v_off + k2
+            if k2 == -d or (k2 != d and v2[k2_off - 1] < v2[k2_off + 1]):
+                x2 = v2[k2_off + 1]
+            else:
+                x2 = v2[k2_off - 1] + 1
+            y2 = x2 - k2
+            while x2 < N and y2 < M \
+                    and A[a1 - x2 - 1] == B[b1 - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            v2[k2_off] = x2
+            if x2 > N:
+                k2end += 2
+            elif y2 > M:
+                k2start += 2
+            elif not front:
+                k1_off = v_off + delta - k2
+                if 0 <= k1_off < len(v1) and v1[k1_off] != -1:
+                    x1 = v1[k1_off]
+                    y1 = v_off + x1 - k1_off
+                    if x1 >= (N - x2):
+                        return _split(x1, y1)
+
+    # no common lines
+    return ([], [])
+
+
+def increasing_pairs(pairs):
+    """Return the longest subsequence of pairs (i, j), sorted by j, in which
+    i is increasing, too (using patience sorting).
+    """
+    tops, top_idx = [], []
+    prev = [None] * len(pairs)
+    for (n, (i, j)) in enumerate(pairs):
+        pile = bisect.bisect_left(tops, i)
+        if pile:
+            prev[n] = top_idx[pile - 1]
+        if pile == len(tops):
+            tops.append(i)
+            top_idx.append(n)
+        else:
+            tops[pile] = i
+            top_idx[pile] = n
+
+    res = []
+    n = top_idx[-1] if top_idx else None
+    while n is not None:
+        res.append(pairs[n])
+        n = prev[n]
+    res.reverse()
+    return res
+
+
+def patience_split(A, B, a0, a1, b0, b1):
+    """Split the ranges at the longest increasing sequence of lines which are
+    unique in both ranges (patience diff).
+
+    Falls back to myers_split() if there are no unique common lines.
+    """
+    uniq_a = {}
+    for i in range(a0, a1):
+        uniq_a[A[i]] = None if A[i] in uniq_a else i
+    uniq_b = {}
+    for j in range(b0, b1):
+        if uniq_a.get(B[j]) is not None:
+            uniq_b[B[j]] = None if B[j] in uniq_b else j
+
+    pairs = [(uniq_a[x], j) for (x, j) in uniq_b.items() if j is not None]
+    if not pairs:
+        return myers_split(A, B, a0, a1, b0, b1)
+    pairs.sort(key=lambda p: p[1])
+
+    ranges, blocks = [], []
+    for (i, j) in increasing_pairs(pairs):
+        ranges.append((a0, i, b0, j))
+        blocks.append((i, j, 1))
+        a0, b0 = (i + 1), (j + 1)
+    ranges.append((a0, a1, b0, b1))
+    return (ranges, blocks)
+
+
+def histogram_split(A, B, a0, a1, b0, b1, max_chain=64):
+    """Split the ranges at the longest common region whose lines occur least
+    often in A (histogram diff, as in JGit/git).
+
+    Falls back to myers_split() if all common lines occur more than
+    max_chain times.
+    """
+    occurrences = {}
+    for i in range(a0, a1):
+        occurrences.setdefault(A[i], []).append(i)
+
+    best = None  # (count, i, j, length)
+    best_count = max_chain
+
+    j = b0
+    while j < b1:
+        next_j = j + 1
+        positions = occurrences.get(B[j], ())
+        if len(positions) <= best_count:
+            for i in positions:
+                si, sj = i, j
+                while si > a0 and sj > b0 and A[si - 1] == B[sj - 1]:
+                    si -= 1
+                    sj -= 1
+                ei, ej = (i + 1), (j + 1)
+                while ei < a1 and ej < b1 and A[ei] == B[ej]:
+                    ei += 1
+                    ej += 1
+
+                count = min(len(occurrences[A[x]]) for x in range(si, ei))
+                if best is None or count < best[0] \
+                        or (count == best[0] and (ei - si) > best[3]):
+                    best = (count, si, sj, (ei - si))
+                    best_count = count
+                next_j = max(next_j, ej)
+        j = next_j
+
+    if best is None:
+        return myers_split(A, B, a0, a1, b0, b1)
+
+    _, i, j, length = best
+    return ([(a0, i, b0, j), ((i + length), a1, (j + length), b1)],
+            [(i, j, length)])
+
+
+def difflib_blocks(a, b):
+    """Matching blocks as computed by difflib.SequenceMatcher."""
+    return difflib.SequenceMatcher(None, a, b).get_matching_blocks()
+
+
+DIFF_ALGORITHMS = {
+    "difflib": difflib_blocks,
+    "myers": lambda a, b: diff_blocks(a, b, myers_split),
+    "patience": lambda a, b: diff_blocks(a, b, patience_split),
+    "histogram": lambda a, b: diff_blocks(a, b, histogram_split),
+}
+
+
+def diff_matcher(a, b, algorithm="difflib"):
+    """Return a difflib.SequenceMatcher-like object for a and b whose
+    matching blocks have been computed using the given diff algorithm.
+    """
+    return BlocksMatcher(a, b, DIFF_ALGORITHMS[algorithm](a, b))
+
+
+def join_unified_diffs(parts, fromfile="", tofile=""):
+    """Join the hunks of multiple unified diffs (each one an iterable of diff
+    lines incl. header) into a single unified diff.
+    """
+    started = False
+    for udiff_lines in parts:
+        udiff_lines = iter(udiff_lines)
+
+        # skip the part's header
+        like = next(udiff_lines, None)
+        if like is None:
+            continue
+        next(udiff_lines)
+        if not started:
+            yield diff_literal("--- %s\n" % (fromfile), like)
+            yield diff_literal("+++ %s\n" % (tofile), like)
+            started = True
+
+        yield from udiff_lines
+
+
+def stream_unified_diff(fa, fb, fromfile="", tofile="", n=3,
+                        algorithm="difflib"):
+    """Like difflib.unified_diff(), but reads the lines of fa and fb
+    incrementally.
+
+    Both inputs are compared line by line. When they diverge, lines are
+    buffered until the inputs resynchronise on a run of 2n+1 common lines.
+    Only then the buffered region is diffed (using algorithm).
+    Memory usage is thus bounded by the size of the largest hunk instead of
+    the size of the inputs.
+    """
+    def regions():
+        ra, rb = PushbackIterator(fa), PushbackIterator(fb)
+        context = collections.deque(maxlen=n)
+        a_pos = b_pos = 0  # line offsets of the end of context
+
+        while True:
+            la, lb = next(ra, None), next(rb, None)
+            if la is None and lb is None:
+                break
+            if la == lb:
+                context.append(la)
+                a_pos += 1
+                b_pos += 1
+                continue
+
+            # The inputs diverge, collect the differing region plus context
+            c = len(context)
+            a_start, b_start = (a_pos - c), (b_pos - c)
+            buf_a, buf_b = list(context), list(context)
+            context.clear()
+            if la is not None:
+                buf_a.append(la)
+            if lb is not None:
+                buf_b.append(lb)
+
+            anchor = find_anchor(ra, rb, buf_a, buf_b, (2 * n + 1))
+            if anchor:
+                i, j = anchor
+                ra.unread(buf_a[(i + n):])
+                rb.unread(buf_b[(j + n):])
+                del buf_a[(i + n):], buf_b[(j + n):]
+            else:
+                i, j = len(buf_a), len(buf_b)
+            a_pos, b_pos = (a_start + len(buf_a)), (b_start + len(buf_b))
+
+            # Only diff the lines between the context and the anchor so that
+            # they stay aligned.
+            core_blocks = DIFF_ALGORITHMS[algorithm](buf_a[c:i], buf_b[c:j])
+            blocks = merge_blocks(itertools.chain(
+                [(0, 0, c)],
+                ((ba + c, bb + c, size) for (ba, bb, size) in core_blocks),
+                [(i, j, (len(buf_a) - i))]))
+            blocks.append((len(buf_a), len(buf_b), 0))
+
+            yield unified_diff(
+                BlocksMatcher(buf_a, buf_b, blocks), n=n,
+                offsets=(a_start, b_start))
+            del buf_a, buf_b
+
+    return join_unified_diffs(regions(), fromfile, tofile)
+
+
+def split_points(a, b, n=3, min_lines=1000):
+    """Find points at which a and b can be cut into segments which can be
+    diffed independently.
+
+    Cut points are lines which occur exactly once in both a and b, are in
+    the same order in both (cf. patience_split()) and are surrounded by at
+    least n common lines on each side (so that no hunk can span a cut).
+
+    Returns a list of (i, j) indices, at least min_lines lines apart.
+    """
+    count_a, count_b = Counter(a), Counter(b)
+    uniq_a = {line: i for (i, line) in enumerate(a) if count_a[line] == 1}
+    pairs = [(uniq_a[line], j) for (j, line) in enumerate(b)
+             if count_b[line] == 1 and line in uniq_a]
+    del count_a, count_b, uniq_a
+
+    res, last = [], 0
+    for (i, j) in increasing_pairs(pairs):
+        if (i - last) < min_lines or i < n or j < n:
+            continue
+        if a[(i - n):(i + n + 1)] == b[(j - n):(j + n + 1)]:
+            res.append((i, j))
+            last = i
+    return res
+
+
+def diff_segment(algorithm, segment):
+    """Return the matching blocks of a segment, i.e. either a pair of lists of
+    lines or the ranges (i0, i1, j0, j1) of the lines in SHARED_LINES.
+    """
+    if len(segment) == 4:
+        i0, i1, j0, j1 = segment
+        segment = (SHARED_LINES[0][i0:i1], SHARED_LINES[1][j0:j1])
+    return DIFF_ALGORITHMS[algorithm](*segment)
+
+
+def parallel_unified_diff(pool, a, b, fromfile="", tofile="", n=3,
+                          algorithm="difflib", min_lines=1000, shared=False):
+    """Like difflib.unified_diff(), but cuts a and b into segments (cf.
+    split_points()) which are diffed in parallel by the workers of pool.
+
+    If shared is True, a and b are SHARED_LINES and only the ranges of the
+    segments are sent to the workers.
+    """
+    cuts = [(0, 0)] + split_points(a, b, n, min_lines) + [(len(a), len(b))]
+    ranges = [(i0, i1, j0, j1)
+              for ((i0, j0), (i1, j1)) in zip(cuts, cuts[1:])]
+    if shared:
+        segments = ranges
+    else:
+        segments = [(a[i0:i1], b[j0:j1]) for (i0, i1, j0, j1) in ranges]
+
+    return join_unified_diffs((
+        unified_diff(
+            BlocksMatcher(a[i0:i1], b[j0:j1], blocks), n=n, offsets=(i0, j0))
+        for ((i0, i1, j0, j1), blocks) in zip(ranges, (pool.imap if pool else map)(
+            functools.partial(diff_segment, algorithm), segments))),
+        fromfile, tofile)
+
+
+def tree_files(root):
+    """Return a dict mapping the paths (relative to root) of the regular files
+    in the directory tree root to their stat results.
+    """
+    res = {}
+    for (dirpath, _, filenames) in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            st = os.stat(path)
+            if stat.S_ISREG(st.st_mode):
+                res[os.path.relpath(path, root)] = st
+    return res
+
+
+def file_digest(path, bufsize=(1 << 20)):
+    """Return the SHA-256 digest of the contents of the file at path."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(functools.partial(f.read, bufsize), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+def tree_pairs(root_a, root_b):
+    """Pair the files of the directory trees root_a and root_b by their
+    relative paths.
+
+    Yields (path_a, path_b) for the files which differ, in order of their
+    relative paths. path_a or path_b is None if the file exists only in one
+    of the trees.
+
+    Files with the same size and mtime are assumed to be identical, files
+    with the same size but different mtimes are compared by their hashes.
+    """
+    files_a, files_b = tree_files(root_a), tree_files(root_b)
+
+    for rel in sorted(files_a.keys() | files_b.keys()):
+        st_a, st_b = files_a.get(rel), files_b.get(rel)
+        path_a = os.path.join(root_a, rel) if st_a else None
+        path_b = os.path.join(root_b, rel) if st_b else None
+
+        if st_a and st_b and st_a.st_size == st_b.st_size:
+            if st_a.st_mtime_ns == st_b.st_mtime_ns \
+                    or file_digest(path_a) == file_digest(path_b):
+                continue
+
+        yield (path_a, path_b)
+
+
+def file_unified_diff(path_a, path_b, pool=None, n=3, algorithm="difflib",
+                      stream=False, parallel=False, binary=False):
+    """Unified diff of the files at path_a and path_b (None means that the
+    file does not exist, it is diffed as an empty file).
+
+    If binary is True, the lines are bytes (cf. read_lines()).
+    """
+    mode = "rb" if binary else "r"
+    with contextlib.ExitStack() as stack:
+        fa = stack.enter_context(open(path_a or os.devnull, mode))
+        fb = stack.enter_context(open(path_b or os.devnull, mode))
+        fromfile, tofile = (path_a or os.devnull), (path_b or os.devnull)
+        if binary:
+            fa = stack.enter_context(read_lines(fa))
+            fb = stack.enter_context(read_lines(fb))
+        if stream:
+            yield from stream_unified_diff(
+                fa, fb, fromfile, tofile, n=n, algorithm=algorithm)
+        elif parallel:
+            yield from parallel_unified_diff(
+                pool, list(fa), list(fb), fromfile, tofile, n=n,
+                algorithm=algorithm)
+        else:
+            yield from unified_diff(
+                diff_matcher(list(fa), list(fb), algorithm),
+                fromfile, tofile, n=n)
+
+
+def assemble_file_hunks(udiffs, headers):
+    """Yield the Hunk objects of multiple unified diffs.
+
+    For every hunk the header lines ("---", "+++") of the diff it belongs to
+    are appended to the deque headers.
+    """
+    for udiff_lines in udiffs:
+        udiff_lines = iter(udiff_lines)
+        header = tuple(itertools.islice(udiff_lines, 2))
+        for hunk in assemble_hunks(udiff_lines):
+            headers.append(header)
+            yield hunk
+
+
+def read_unified_diffs(f):
+    """Split a (single or multi-file) unified diff, e.g. the output of
+    "diff -u" or "git diff", into the diffs of the individual files.
+
+    Yields an iterator over the lines (header and hunks) of every file's diff.
+    Lines which are neither part of a header nor of a hunk (e.g.
+    "diff --git ...", "\\ No newline at end of file") are dropped.
+
+    The lines of f can be str or bytes.
+    """
+    lines = PushbackIterator(f)
+
+    def file_lines(header):
+        yield from header
+        for line in lines:
+            if line[:2] not in ("@@", b"@@"):
+                lines.unread([line])
+                break
+            hunk_range = Hunk.Range.fromstr(line)
+            yield line
+
+            # the range tells how many lines belong to the hunk
+            a_lines, b_lines = hunk_range.a_lines, hunk_range.b_lines
+            while a_lines > 0 or b_lines > 0:
+                line = next(lines, None)
+                if line is None:
+                    raise ValueError("unexpected end of diff in hunk: %s" % (
+                        str(hunk_range).rstrip("\n")))
+                if line[:1] in ("\\", b"\\"):
+                    continue  # "\ No newline at end of file"
+                if line in ("\n", "", b"\n", b""):
+                    # context line stripped of its whitespace
+                    line = diff_literal(" \n", line)
+                if line[:1] in (" ", "-", b" ", b"-"):
+                    a_lines -= 1
+                if line[:1] in (" ", "+", b" ", b"+"):
+                    b_lines -= 1
+                yield line
+
+    for line in lines:
+        if line[:4] not in ("--- ", b"--- "):
+            continue
+        plus = next(lines, None)
+        if plus is None or plus[:4] not in ("+++ ", b"+++ "):
+            lines.unread([plus] if plus is not None else [])
+            continue
+
+        udiff_lines = file_lines((line, plus))
+        yield udiff_lines
+        collections.deque(udiff_lines, maxlen=0)  # skip unconsumed lines
+
+
+class HunkCache:
+    """Persistent cache of process_hunk() results.
+
+    The diff lines of a hunk are stored in a file (in directory path) named
+    by a hash of the hunk's lines, the regular expressions and settings (other
+    parameters which affect the results). When the total size of the files
+    exceeds max_size, the least recently used files are removed (cf. trim()).
+    """
+    VERSION = 2  # bump when process_hunk() output changes
+
+    def __init__(self, path, max_size, settings=(), min_lines=8):
+        self.path = path
+        self.max_size = max_size
+        self.settings = settings
+        self.min_lines = min_lines  # smaller hunks are cheaper to recompute
+
+    def key(self, re_progs, lines_a, lines_b):
+        """Return the cache key of a hunk."""
+        h = hashlib.sha256(repr(
+            (self.VERSION, [(p.pattern, p.flags) for p in re_progs],
+             self.settings, len(lines_a), len(lines_b))).encode())
+        for line in itertools.chain(lines_a, lines_b):
+            h.update(line if isinstance(line, bytes)
+                     else line.encode("utf-8", "surrogateescape"))
+        return h.hexdigest()
+
+    def __file(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        """Return the cached diff lines for key (or None)."""
+        try:
+            with open(self.__file(key), "rb") as f:
+                lines = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        try:
+            os.utime(self.__file(key))  # mark as recently used
+        except OSError:
+            pass
+        return lines
+
+    def put(self, key, lines):
+        """Store the diff lines for key."""
+        path = self.__file(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%u.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            pickle.dump(lines, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def lookup(self, hunks, re_progs, keys):
+        """Look up the hunks in the cache.
+
+        Sets Hunk.cached of the hunks found, for the others the key to store
+        their results under is appended to keys (None for hits and hunks
+        which are not cached).
+        """
+        for hunk in hunks:
+            key = None
+            if len(hunk.lines_a) + len(hunk.lines_b) >= self.min_lines:
+                key = self.key(re_progs, hunk.lines_a, hunk.lines_b)
+                hunk.cached = self.get(key)
+                if hunk.cached is not None:
+                    key = None
+                    if STATS is not None:
+                        STATS.counters["hunks cached"] += 1
+            keys.append(key)
+            yield hunk
+
+    def files(self):
+        """Yield os.DirEntry objects of the cache files."""
+        try:
+            subdirs = [e for e in os.scandir(self.path) if e.is_dir()]
+        except FileNotFoundError:
+            return
+        for subdir in subdirs:
+            yield from os.scandir(subdir.path)
+
+    def trim(self):
+        """Remove the least recently used files until the cache fits into
+        max_size.
+        """
+        entries = sorted(
+            ((e.stat().st_mtime_ns, e.stat().st_size, e.path)
+             for e in self.files()), reverse=True)
+        size = sum(e[1] for e in entries)
+        while size > self.max_size and entries:
+            _, file_size, path = entries.pop()
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+
+    def clear(self):
+        """Remove all cached results."""
+        for entry in self.files():
+            os.unlink(entry.path)
+
+
+class Stats:
+    """Wall/CPU time per stage and counters of a run (cf. --stats).
+
+    Stages can be nested, the time of a stage does not include the time
+    spent in the stages entered from it. prefix is prepended to the stage
+    names (to distinguish the stages of worker processes).
+    """
+
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self.times = {}  # stage -> [wall, cpu, count]
+        self.counters = Counter()
+        self._stack = []
+        self._last = None
+
+    def _switch(self):
+        now = (time.perf_counter(), time.process_time())
+        if self._stack:
+            t = self.times[self._stack[-1]]
+            t[0] += (now[0] - self._last[0])
+            t[1] += (now[1] - self._last[1])
+        self._last = now
+
+    def enter(self, stage):
+        self._switch()
+        stage = self.prefix + stage
+        self._stack.append(stage)
+        self.times.setdefault(stage, [0.0, 0.0, 0])[2] += 1
+
+    def exit(self):
+        self._switch()
+        self._stack.pop()
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        self.enter(stage)
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def iter(self, stage, iterable):
+        """Iterate over iterable, the time spent in it is accounted to stage.
+        """
+        it = iter(iterable)
+        while True:
+            self.enter(stage)
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            yield item
+
+    def peak(self, name, value):
+        """Set counter name to value if it is larger."""
+        self.counters[name] = max(self.counters[name], value)
+
+    def take(self):
+        """Return (times, counters) and reset them (in a worker)."""
+        res = (self.times, self.counters)
+        self.times, self.counters = {}, Counter()
+        return res
+
+    def merge(self, times, counters):
+        """Add times and counters (cf. take()) to these stats."""
+        for (stage, t) in times.items():
+            own = self.times.setdefault(stage, [0.0, 0.0, 0])
+            for i in range(3):
+                own[i] += t[i]
+        for (name, value) in counters.items():
+            if name.startswith("largest "):
+                self.peak(name, value)
+            else:
+                self.counters[name] += value
+
+    def report(self, wall, cpu, jobs):
+        """Return the stats as a dict (wall and cpu are the totals of this
+        process, jobs is the number of worker processes).
+        """
+        busy = sum(t[0] for (stage, t) in self.times.items()
+                   if stage.startswith("worker "))
+        return {
+            "wall": wall,
+            "cpu": cpu,
+            "stages": {
+                stage: {"wall": t[0], "cpu": t[1], "count": t[2]}
+                for (stage, t) in self.times.items()},
+            "counters": dict(self.counters),
+            "workers": jobs,
+            "worker_utilisation": (busy / (jobs * wall)) if jobs else None,
+        }
+
+
+def print_stats(report, fd):
+    """Print report (cf. Stats.report()) to fd."""
+    print("%-32s %10s %10s %10s" % ("stage", "wall [s]", "cpu [s]", "count"),
+          file=fd)
+    for (stage, t) in report["stages"].items():
+        print("%-32s %10.3f %10.3f %10u" % (
+            stage, t["wall"], t["cpu"], t["count"]), file=fd)
+    print("%-32s %10.3f %10.3f" % ("total", report["wall"], report["cpu"]),
+          file=fd)
+    print(file=fd)
+    for (name, value) in sorted(report["counters"].items()):
+        print("%-32s %10u" % (name, value), file=fd)
+    if report["workers"]:
+        print("%-32s %9.1f%%" % (
+            "worker utilisation (%u workers)" % report["workers"],
+            (100 * report["worker_utilisation"])), file=fd)
+
+
+def enable_stats(prefix=""):
+    """Enable --stats in this process (e.g. as Pool initializer)."""
+    global STATS
+    STATS = Stats(prefix)
+
+
+def timed(stage, func, *args):
+    """Return func(*args), the time spent is accounted to stage if --stats
+    is enabled.
+    """
+    if STATS is None:
+        return func(*args)
+    with STATS.stage(stage):
+        return func(*args)
+
+
+def timed_iter(stage, iterable):
+    """Like timed(), but for the time spent iterating over iterable."""
+    return iterable if STATS is None else STATS.iter(stage, iterable)
+
+
+def annotate_hunks(hunks, re_progs):
+    """Scan the lines of the hunks for matches of each of re_progs (cf.
+    Hunk.matches).
+
+    Hunks with cached results (cf. HunkCache) are not scanned.
+    """
+    for hunk in hunks:
+        if hunk.cached is not None:
+            yield hunk
+            continue
+        hunk.matches = [
+            scan_matches(re_prog, itertools.chain(hunk.lines_a, hunk.lines_b))
+            for re_prog in re_progs]
+        yield hunk
+
+
+def batch_hunks(hunks, shared=False, min_lines=64, max_lines=4096):
+    """Group hunks into batches for imap_bounded().
+
+    Hunks without any matches (cf. annotate_hunks()) only need their lines to
+    be mapped (to find added/removed lines), which is cheaper than the IPC, so
+    they are marked to be processed inline (as are hunks with cached results).
+
+    A batch is closed once the hunks to be sent to a worker contain target
+    lines. target starts at min_lines and is doubled with every batch (up to
+    max_lines), so that the first results arrive quickly.
+
+    If shared is True, the lines of the hunks sent to workers are dropped,
+    because the workers inherited them (cf. SHARED_LINES).
+    """
+    batch, nlines = [], 0
+    target = min_lines
+    for hunk in hunks:
+        inline = hunk.cached is not None or not any(hunk.matches)
+        if not inline:
+            nlines += len(hunk.lines_a) + len(hunk.lines_b)
+            if shared:
+                hunk.lines_a = hunk.lines_b = hunk.matches = None
+        batch.append((inline, hunk))
+
+        if nlines >= target or len(batch) >= target:
+            yield batch
+            batch, nlines = [], 0
+            target = min((2 * target), max_lines)
+    if batch:
+        yield batch
+
+
+def call_batch(func, items):
+    """Return [func(item) for item in items] (in a worker) and the worker's
+    stats for them (cf. Stats.take(), None unless --stats is enabled).
+    """
+    if STATS is None:
+        return ([func(item) for item in items], None)
+
+    res = [timed("process_hunk", func, item) for item in items]
+    STATS.counters["ipc bytes received"] += len(pickle.dumps(res))
+    return (res, STATS.take())
+
+
+def imap_bounded(pool, func, batches, maxpending):
+    """Like Pool.imap(), but for batches of (inline, item) tuples (cf.
+    batch_hunks()): yields func(item) for all items in order.
+
+    At most maxpending batches are in flight, so that batches is consumed
+    lazily. Items marked inline are processed in this process instead of
+    being sent to a worker (also all items if pool is None).
+    """
+    pending = collections.deque()
+
+    def results(entry):
+        local, remote = entry
+        if remote is not None:
+            remote, stats = timed("wait for workers", remote.get)
+            if stats is not None:
+                STATS.merge(*stats)
+        remote = iter(remote or ())
+        for (inline, res) in local:
+            yield res if inline else next(remote)
+
+    for batch in batches:
+        remote_items = [item for (inline, item) in batch if not inline]
+        if pool is None or not remote_items:
+            remote_items = []
+        if STATS is not None:
+            STATS.counters["hunks inline"] += len(batch) - len(remote_items)
+
+        if remote_items:
+            if STATS is not None:
+                STATS.counters["batches sent"] += 1
+                STATS.counters["hunks sent"] += len(remote_items)
+                STATS.counters["ipc bytes sent"] += len(
+                    pickle.dumps((func, remote_items)))
+            remote = pool.apply_async(call_batch, (func, remote_items))
+            local = [(inline, (timed("process_hunk", func, item)
+                               if inline else None))
+                     for (inline, item) in batch]
+        else:
+            remote = None
+            local = [(True, timed("process_hunk", func, item))
+                     for (_, item) in batch]
+        pending.append((local, remote))
+
+        if len(pending) >= maxpending:
+            yield from results(pending.popleft())
+    while pending:
+        yield from results(pending.popleft())
+
+
+def process_hunk(re_progs, hunk, diff_spans_func=line_diff_spans):
     """Process a hunk, i.e. process the diff lines and filter the interesting
     ones (i.e. overlap with a regular expression match).
+
+    Returns the hunk's range and a list of diff lines for each of re_progs.
     """
+    if hunk.cached is not None:
+        return (hunk.range, hunk.cached)
+    if hunk.lines_a is None:
+        # lines have been inherited from the parent process
+        hunk.load_lines(*SHARED_LINES)
+
     try:
-        return (hunk.range, list(strip_diff(
-            hunk.lines_a, hunk.lines_b, re_prog)))
+        return (hunk.range, strip_diffs(
+            hunk.lines_a, hunk.lines_b, re_progs, hunk.matches,
+            diff_spans_func))
     except RuntimeError as e:
         print(*e.args, sep="\n", file=sys.stderr)
         raise RuntimeError(
             "failed to process hunk: %s" % hunk.range) from None
 
 
+class FilteredDiff:
+    """Output of the filtered diff for one regular expression.
+
+    Keeps track of the offset of the new file's lines (which changes as
+    changes are "stripped") and prints the file header before the first
+    hunk of a file. If tag is given, it is prepended to every line.
+    """
+    # prefixes of diff lines (str or bytes)
+    A_PREFIXES = (" ", "-", b" ", b"-")
+    B_PREFIXES = (" ", "+", b" ", b"+")
+    CHANGE_PREFIXES = ("-", "+", b"-", b"+")
+
+    def __init__(self, fd, tag=None):
+        self.fd = fd
+        self.tag = tag
+        self.printed_header = None
+        self.b_offset = 0
+
+    def write(self, lines):
+        if self.tag:
+            lines = (self.tag + ln for ln in lines)
+        self.fd.writelines(lines)
+
+    @staticmethod
+    def terminate_lines(lines):
+        """Terminate a last line without newline like diff -u does."""
+        for ln in lines:
+            if ln[-1:] in ("\n", b"\n"):
+                yield ln
+            else:
+                yield ln + diff_literal("\n", ln)
+                yield diff_literal("\\ No newline at end of file\n", ln)
+
+    def print_header(self, header):
+        self.write(header)
+        self.printed_header = header
+
+    def print_hunk(self, header, hunk_range, lines, first):
+        """Print the diff lines of a hunk with updated hunk_range.
+        first must be True for the first hunk of a file.
+        """
+        if first:
+            self.b_offset = 0
+
+        # # Remove all trailing context lines
+        # while stripped and stripped[-1][0] == " ":
+        #     stripped.pop()
+
+        # Update range line counts because lines have been "stripped"
+        new_a_lines = sum(1 for ln in lines if ln[:1] in self.A_PREFIXES)
+        new_b_lines = sum(1 for ln in lines if ln[:1] in self.B_PREFIXES)
+
+        # The start of an empty range is the line before it (cf. diff -u),
+        # e.g. "@@ -0,0 +1,2 @@" for an added file.
+        b_begin = hunk_range.a_begin + self.b_offset
+        if not new_a_lines:
+            b_begin += 1
+        if not new_b_lines:
+            b_begin = max(0, (b_begin - 1))
+        self.b_offset += (new_b_lines - new_a_lines)
+
+        hunk_range = Hunk.Range(
+            hunk_range.a_begin, new_a_lines, b_begin, new_b_lines)
+
+        if any(ln[:1] in self.CHANGE_PREFIXES for ln in lines):
+            # lines have changed -> print new lines
+            if header != self.printed_header:
+                self.print_header(header)
+            self.write((diff_literal(str(hunk_range), header[0]),))
+            self.write(self.terminate_lines(lines))
+
+
 if __name__ == "__main__":
-    re_diff = re.compile(sys.argv[3])
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="diff-by-regex.py",
+        description="Produce a unified diff of two files, but only for lines "
+        "where a difference overlaps with a regex match.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--stream", action="store_true", default=False,
+        help="read the files incrementally (memory usage is bounded by the "
+        "largest hunk instead of the file sizes)")
+    mode.add_argument(
+        "--parallel-diff", action="store_true", default=False,
+        help="cut the files at common lines and diff the segments in "
+        "parallel")
+    mode.add_argument(
+        "--from-diff", metavar="DIFF",
+        help="filter an existing unified diff (\"-\" for stdin) instead of "
+        "diffing file1 and file2")
+    parser.add_argument(
+        "--algorithm", choices=DIFF_ALGORITHMS.keys(), default="difflib",
+        help="line diff algorithm (default: %(default)s)")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=(os.cpu_count() or 1),
+        help="number of worker processes (default: %(default)s)")
+    parser.add_argument(
+        "--bytes", action="store_true", default=False,
+        help="process the files as bytes (memory-mapped, nothing is "
+        "decoded), e.g. for files with mixed or invalid encodings")
+    parser.add_argument(
+        "--intraline", choices=INTRALINE_DIFFS.keys(), default="char",
+        help="compare modified lines by characters or by word/punctuation "
+        "tokens (default: %(default)s)")
+    parser.add_argument(
+        "--max-line-length", type=int, default=10000, metavar="N",
+        help="consider modified lines longer than N characters to be changed "
+        "completely (default: %(default)s)")
+    parser.add_argument(
+        "--cache-dir", default=os.path.join(
+            os.environ.get("XDG_CACHE_HOME") or
+            os.path.join(os.path.expanduser("~"), ".cache"),
+            "diff-by-regex"),
+        help="directory of the hunk result cache (default: %(default)s)")
+    parser.add_argument(
+        "--cache-size", type=int, default=256, metavar="MB",
+        help="maximum size of the hunk result cache (default: %(default)s)")
+    parser.add_argument(
+        "--no-cache", action="store_true", default=False,
+        help="do not use the hunk result cache")
+    parser.add_argument(
+        "--clear-cache", action="store_true", default=False,
+        help="remove all cached hunk results before running")
+    parser.add_argument(
+        "--stats", action="store_true", default=False,
+        help="print timings per stage and counters to stderr")
+    parser.add_argument(
+        "--stats-json", metavar="FILE",
+        help="write timings per stage and counters as JSON to FILE")
+    parser.add_argument(
+        "-e", "--regex", action="append", dest="patterns", default=[],
+        metavar="NAME=REGEX",
+        help="filter by a named regex (can be given multiple times, the "
+        "regex argument is omitted then)")
+    parser.add_argument(
+        "-o", "--output", metavar="TEMPLATE",
+        help="write the diff of each named regex to the file TEMPLATE with "
+        "{name} replaced by its name (default: stdout, every line prefixed "
+        "with \"NAME:\")")
+    parser.add_argument("args", nargs="*", metavar="file1 file2 regex")
+    options = parser.parse_args()
+
+    if options.patterns:
+        options.files = options.args
+        patterns = []
+        for pattern in options.patterns:
+            name, sep, regex = pattern.partition("=")
+            if not (sep and re.fullmatch(r"\w+", name)):
+                parser.error("invalid named regex: %s" % (pattern))
+            patterns.append((name, regex))
+        if len(set(name for (name, _) in patterns)) != len(patterns):
+            parser.error("regex names must be unique")
+        if options.output and len(patterns) > 1 \
+                and "{name}" not in options.output:
+            parser.error("--output must contain {name}")
+    elif options.args:
+        options.files = options.args[:-1]
+        patterns = [(None, options.args[-1])]
+        if options.output:
+            parser.error("--output requires named regexes (-e)")
+    else:
+        parser.error("a regex is required")
+
+    if len(options.files) != (0 if options.from_diff else 2):
+        parser.error("either file1 and file2 or --from-diff are required")
+    if len(set(map(os.path.isdir, options.files))) > 1:
+        parser.error("file1 and file2 must both be files or directories")
 
-    with open(sys.argv[1]) as fa, open(sys.argv[2]) as fb:
-        udiff_lines = difflib.unified_diff(
-            list(fa), list(fb), fa.name, fb.name, n=3)
+    re_diffs = [re.compile(os.fsencode(regex) if options.bytes else regex)
+                for (_, regex) in patterns]
 
-    import functools
+    intraline = (options.intraline, options.max_line_length)
+    diff_spans_func = functools.partial(
+        intraline_diff_spans, mode=intraline[0], max_length=intraline[1])
+
+    cache = HunkCache(
+        options.cache_dir, (options.cache_size << 20), settings=intraline)
+    if options.clear_cache:
+        cache.clear()
+    if options.no_cache:
+        cache = None
 
     import multiprocessing as mp
-    mp.set_start_method('fork')  # workaround
-
-    # Unified diff header
-    sys.stdout.write(next(udiff_lines))
-    sys.stdout.write(next(udiff_lines))
-
-    with mp.Pool() as pool:
-        b_offset = 0
-        hunk_gen = assemble_hunks(udiff_lines)
-
-        for hunk_range, lines in pool.imap(
-                functools.partial(process_hunk, re_diff), hunk_gen):
-            # # Remove all trailing context lines
-            # while stripped and stripped[-1][0] == " ":
-            #     stripped.pop()
-
-            # Update range line counts because lines have been "stripped"
-            new_a_lines = sum(1 for ln in lines if ln.startswith((" ", "-")))
-            new_b_lines = sum(1 for ln in lines if ln.startswith((" ", "+")))
-            b_offset += (new_b_lines - new_a_lines)
-
-            hunk_range.b_begin = (hunk_range.a_begin + b_offset)
-            hunk_range.a_lines = new_a_lines
-            hunk_range.b_lines = new_b_lines
-
-            if any(ln.startswith(("-", "+")) for ln in lines):
-                # lines have changed -> print new lines
-                print(str(hunk_range), *lines, sep="", end="")
+
+    if options.stats or options.stats_json:
+        enable_stats()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+
+    # workaround, also workers need to inherit SHARED_LINES
+    shared = "fork" in mp.get_all_start_methods()
+    if shared:
+        mp.set_start_method("fork")
+
+    # multiple files (headers are only printed for files with changes)
+    multi_mode = options.from_diff or all(map(os.path.isdir, options.files))
+
+    with contextlib.ExitStack() as stack:
+        if options.bytes:
+            mode, like = "rb", b""
+            stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+        else:
+            mode, like = "r", ""
+            stdin, stdout = sys.stdin, sys.stdout
+
+        outputs = []
+        for (name, _) in patterns:
+            if options.output:
+                outputs.append(FilteredDiff(stack.enter_context(
+                    open(options.output.format(name=name), ("w" + mode[1:])))))
+            else:
+                outputs.append(FilteredDiff(
+                    stdout, (name and diff_literal(("%s:" % name), like))))
+
+        if not multi_mode:
+            fa = stack.enter_context(open(options.files[0], mode))
+            fb = stack.enter_context(open(options.files[1], mode))
+            if options.bytes:
+                fa = stack.enter_context(read_lines(fa))
+                fb = stack.enter_context(read_lines(fb))
+            if not options.stream:
+                SHARED_LINES = timed("read", lambda: (list(fa), list(fb)))
+
+        pool = None
+        if options.jobs > 1:
+            pool = mp.Pool(
+                options.jobs, initializer=(enable_stats if STATS else None),
+                initargs=("worker ",))
+        if pool is not None:
+            stack.enter_context(pool)
+        shared = shared and pool is not None and SHARED_LINES is not None
+
+        if options.from_diff:
+            udiffs = read_unified_diffs(
+                stdin if options.from_diff == "-" else
+                stack.enter_context(open(options.from_diff, mode)))
+        elif multi_mode:
+            udiffs = (
+                file_unified_diff(
+                    path_a, path_b, pool, n=3, algorithm=options.algorithm,
+                    stream=options.stream, parallel=options.parallel_diff,
+                    binary=options.bytes)
+                for (path_a, path_b) in tree_pairs(*options.files))
+        elif options.stream:
+            udiffs = [stream_unified_diff(
+                fa, fb, *options.files, n=3, algorithm=options.algorithm)]
+        elif options.parallel_diff:
+            udiffs = [parallel_unified_diff(
+                pool, *SHARED_LINES, *options.files, n=3,
+                algorithm=options.algorithm, shared=shared)]
+        else:
+            udiffs = [unified_diff(
+                timed("diff", diff_matcher, *SHARED_LINES, options.algorithm),
+                *options.files, n=3)]
+
+        if not multi_mode:
+            # Unified diff header (always printed for a single pair of files)
+            udiffs[0] = iter(udiffs[0])
+            header = tuple(itertools.islice(udiffs[0], 2))
+            for output in outputs:
+                output.print_header(header)
+            udiffs[0] = itertools.chain(header, udiffs[0])
+        udiffs = (timed_iter("diff", udiff_lines)
+                  for udiff_lines in timed_iter("diff", udiffs))
+
+        headers = collections.deque()
+        current_header = None
+        hunks = timed_iter("assemble", assemble_file_hunks(udiffs, headers))
+        cache_keys = collections.deque()
+        if cache is not None:
+            hunks = timed_iter(
+                "cache lookup", cache.lookup(hunks, re_diffs, cache_keys))
+        hunk_batches = timed_iter("batch", batch_hunks(timed_iter(
+            "scan matches", annotate_hunks(hunks, re_diffs)), shared))
+
+        for hunk_range, results in timed_iter("process", imap_bounded(
+                pool, functools.partial(
+                    process_hunk, re_diffs, diff_spans_func=diff_spans_func),
+                hunk_batches, maxpending=(2 * options.jobs))):
+            header = headers.popleft()
+            if cache is not None:
+                cache_key = cache_keys.popleft()
+                if cache_key is not None:
+                    timed("cache store", cache.put, cache_key, results)
+
+            if STATS is not None:
+                nlines = (hunk_range.a_lines + hunk_range.b_lines)
+                STATS.counters["hunks"] += 1
+                STATS.counters["hunk lines"] += nlines
+                STATS.peak("largest hunk (lines)", nlines)
+
+            first = (header != current_header)  # first hunk of a file
+            current_header = header
+            for (output, lines) in zip(outputs, results):
+                timed("output", output.print_hunk,
+                      header, hunk_range, lines, first)
+
+        if cache is not None:
+            timed("cache trim", cache.trim)
+
+    if STATS is not None:
+        report = STATS.report(
+            (time.perf_counter() - start_wall),
+            (time.process_time() - start_cpu),
+            (options.jobs if options.jobs > 1 else 0))
+        if options.stats:
+            print_stats(report, sys.stderr)
+        if options.stats_json:
+            import json
+            with open(options.stats_json, "w") as f:
+                json.dump(report, f, indent=2)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+#
+# Benchmark of the XMLTV writer of tv7.py (XMLTVGenerator.dump()) against
+# the SAX based one (XMLTVGenerator.dump_sax()), and of dump() with the
+# fragment cache (cold, warm and with 5 % of the programmes changed).
+#
+# Generates a reproducible synthetic EPG (including the corner cases of the
+# XMLTV output: characters to escape, empty fields, unknown credit positions,
+# unparsable icon URLs, non-UTC timestamps), checks that all writers produce
+# the same output and prints their times.
+#
+# usage: python3 bench-xmltv.py [--channels N] [--programmes N] [--repeat N]
+#
+
+import datetime
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tv7.py")
+
+WORDS = ["Tagesschau", "Krimi", "Sport", "Wetter", "Doku", "Film", "Serie",
+         "Kinder", "<Live>", "Q&A", '"Best of"', "l'été", "Grüezi", "\t"]
+
+ICONS = [
+    "https://img.example/%u.jpg?w=640&h=360",
+    "https://img.example/%u.jpg?h=180;w=320;q=75",
+    "https://img.example/%u.jpg",  # no query (skipped)
+    "https://img.example/%u.jpg?w",  # unparsable (skipped)
+    "https://img.example/%u.jpg?w=1=2",  # unparsable (skipped)
+    "https://img.example/%u.jpg?w=1&h=2&t=\"'",
+]
+
+TIMEZONES = [datetime.timezone.utc,
+             datetime.timezone(datetime.timedelta(hours=2))]
+
+
+def load_tv7():
+    spec = importlib.util.spec_from_file_location("tv7", SCRIPT)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def text(rnd, n=3):
+    return " ".join(rnd.choice(WORDS) for _ in range(rnd.randrange(1, n + 1)))
+
+
+def gen_channel(i):
+    return {
+        "pk": "channel-%u" % (i),
+        "name": "Kanal %u & Co" % (i),
+        "hd": i % 2,
+        "src": "udp://@239.77.0.%u:5000" % (i),
+        "canonical_name": "ch%u.example" % (i),
+        "logo": "https://logo.example/%u.png?a=1&b=2" % (i),
+        "visible": True,
+        "ordernum": i,
+        "langordernum": i,
+        "country": "CH",
+        "language": ["de", "fr", "it", "en"][i % 4],
+        "has_replay": True,
+        "hls_src": "https://hls.example/%u.m3u8" % (i),
+        "changed": "2024-01-01T00:00:00Z",
+    }
+
+
+def gen_epg(nchannels, nprogrammes, seed=0):
+    """Generate the JSON objects of nprogrammes programmes on nchannels
+    channels.
+    """
+    rnd = random.Random(seed)
+    channels = [gen_channel(i) for i in range(nchannels)]
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    starts = [start] * nchannels
+
+    programmes = []
+    for i in range(nprogrammes):
+        c = i % nchannels
+        lower = starts[c]
+        upper = lower + datetime.timedelta(minutes=rnd.choice((5, 30, 90)))
+        starts[c] = upper
+        tz = rnd.choice(TIMEZONES)
+
+        programmes.append({
+            "pk": "programme-%u" % (i),
+            "timeslot": {
+                "lower": lower.astimezone(tz).isoformat(),
+                "upper": upper.astimezone(tz).isoformat(),
+                "bounds": "[)",
+            },
+            "channel": channels[c],
+            "title": rnd.choice(("", text(rnd))),
+            "sub_title": rnd.choice((None, "", text(rnd))),
+            "desc": rnd.choice((None, text(rnd, 30))),
+            "categories": [rnd.choice(WORDS + [""])
+                           for _ in range(rnd.randrange(3))],
+            "country": rnd.choice((None, "CH", "DE")),
+            "date": rnd.choice((None, 0, 1999, "2024")),
+            "icons": [rnd.choice(ICONS) % (rnd.randrange(100))
+                      for _ in range(rnd.randrange(3))],
+            "credits": [{
+                "position": rnd.choice(("actor", "director", "grip")),
+                "name": rnd.choice(("", text(rnd, 2))),
+            } for _ in range(rnd.randrange(4))],
+            "rating_system": rnd.choice((None, "FSK", 'a"b')),
+            "rating": rnd.choice((None, "12", "<16>")),
+            "episode_num_system": rnd.choice((None, "xmltv_ns", "o'neil")),
+            "episode_num": rnd.choice((None, "", "1.2.0/1")),
+            "premiere": rnd.random() < 0.1,
+            "subtitles": rnd.random() < 0.2,
+            "star_rating": rnd.choice((None, "3/5")),
+        })
+
+    return programmes
+
+
+def change(epg, p, seed=0):
+    """Return a copy of epg with the titles of a fraction p of the programmes
+    changed.
+    """
+    rnd = random.Random(seed)
+    return [
+        dict(programme, title=programme["title"] + " (changed)")
+        if rnd.random() < p else programme
+        for programme in epg]
+
+
+def run(tv7, epg, method, fragments=None):
+    """Return (output, time) of generating the XMLTV of epg with method."""
+    registry = tv7.TV7ChannelRegistry()
+    programmes = [tv7.TV7EPGProgramme.fromjson(p, registry) for p in epg]
+    if fragments is None:
+        for p in programmes:
+            p.decode()
+    else:
+        # like TV7EPGStore.programmes()
+        for (p, j) in zip(programmes, epg):
+            p.digest = hashlib.sha256(json.dumps(j).encode()).digest()
+
+    gen = tv7.XMLTVGenerator(registry, fragments)
+    gen.since = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+    gen.source = programmes
+
+    out = io.StringIO()
+    t = time.perf_counter()
+    getattr(gen, method)(out)
+    return (out.getvalue(), time.perf_counter() - t)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="bench-xmltv.py")
+    parser.add_argument("--channels", type=int, default=200)
+    parser.add_argument("--programmes", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=3)
+    options = parser.parse_args()
+
+    tv7 = load_tv7()
+    # ordered by channel (like the output of --store), so that the fragments
+    # are days of a channel
+    epg = sorted(gen_epg(options.channels, options.programmes),
+                 key=lambda p: p["channel"]["ordernum"])
+    changed = change(epg, 0.05)
+
+    results = {}
+    outputs = {}
+    for method in ("dump_sax", "dump"):
+        for _ in range(options.repeat):
+            (outputs[method], t) = run(tv7, epg, method)
+            results[method] = min(results.get(method, t), t)
+
+    for _ in range(options.repeat):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fragments = tv7.XMLTVFragmentCache(tmpdir, (1 << 30))
+            for (name, data) in (("fragments:cold", epg),
+                                 ("fragments:warm", epg),
+                                 ("fragments:5%", changed)):
+                (outputs[name], t) = run(tv7, data, "dump", fragments)
+                results[name] = min(results.get(name, t), t)
+    (outputs["changed"], _) = run(tv7, changed, "dump")
+
+    print("%-16s %10s %10s" % ("writer", "time [s]", "MB/s"))
+    for (method, t) in results.items():
+        print("%-16s %10.3f %10.1f" % (
+            method, t, len(outputs[method]) / t / (1 << 20)))
+    print("speedup: %.2f" % (results["dump_sax"] / results["dump"]))
+
+    if any(outputs[name] != outputs["dump_sax"]
+           for name in ("dump", "fragments:cold", "fragments:warm")) or \
+            outputs["fragments:5%"] != outputs["changed"]:
+        print("error: the outputs differ", file=sys.stderr)
+        sys.exit(1)
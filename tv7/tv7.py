@@ -1,13 +1,34 @@
 #!/usr/bin/python3
 
+import base64
+import bisect
+import codecs
 import collections
+import concurrent.futures
 import datetime
+import email.utils
+import functools
+import gzip
+import hashlib
+import http.client
+import http.server
+import io
 import itertools
 import json
+import math
+import operator
 import os
+import pickle
 import re
+import signal
+import socketserver
+import sqlite3
 import stat
 import sys
+import threading
+import time
+import traceback
+import urllib.error
 import urllib.parse
 import urllib.request
 
@@ -22,9 +43,42 @@ def datetime_from_iso(iso_s):
     return datetime.datetime.fromisoformat(iso_s)
 
 
+if sys.version_info >= (3, 11):
+    # fromisoformat() accepts the "Z" suffix since Python 3.11
+    datetime_from_iso = datetime.datetime.fromisoformat
+
+
+def parse_days(s):
+    """Parse a (non-negative, finite) number of days."""
+    days = float(s)
+    if not math.isfinite(days) or days < 0:
+        raise ValueError("invalid number of days: %r" % (s))
+    return days
+
+
+def days_after(since, days):
+    """Return since + days (None if days is None or the result is out of the
+    range of datetime, i.e. unlimited).
+    """
+    if days is None:
+        return None
+    try:
+        return since + datetime.timedelta(days=days)
+    except OverflowError:
+        return None
+
+
 class XMLTVGenerator:
-    def __init__(self):
-        self.channels = set()
+    CREDIT_POSITIONS = (
+        "actor", "adapter", "commentator", "composer", "director", "editor",
+        "guest", "presenter", "producer", "writer")
+
+    def __init__(self, channels=None, fragments=None, stats=None):
+        self.channels = TV7ChannelRegistry() if channels is None else channels
+        self.fragments = fragments  # XMLTVFragmentCache
+        self.stats = stats  # TV7Stats
+        self.since = None  # default: now
+        self.until = None
 
     @staticmethod
     def __sax_attrs(attrs={}):
@@ -89,10 +143,7 @@ class XMLTVGenerator:
             handler.startElement("credits", self.__sax_attrs({}))
 
             for credit in programme.credits:
-                if credit.position in (
-                        "actor", "adapter", "commentator", "composer",
-                        "director", "editor", "guest", "presenter", "producer",
-                        "writer"):
+                if credit.position in self.CREDIT_POSITIONS:
                     self.__sax_generate_element(
                         handler, credit.position, text=credit.name)
             handler.endElement("credits")
@@ -171,16 +222,291 @@ class XMLTVGenerator:
 
         handler.endElement("programme")
 
-    def fromtv7epg(self, channels=None):
+    def fromtv7epg(self, channels=None, api=None, since=None, until=None):
+        api = api or TV7API(registry=self.channels)
+        (self.since, self.until) = (since, until)
         if channels:
-            self.source = itertools.chain.from_iterable(
-                TV7EPG.forchannel(c) for c in channels)
+            self.source = TV7EPG.forchannels(channels, api, until)
         else:
-            self.source = TV7EPG.allchannels()
+            self.source = TV7EPG.allchannels(api, until)
 
-    def dump(self, fd=sys.stdout):
-        now = datetime.datetime.now(datetime.timezone.utc)
+    def fromstore(self, store, channels=None, since=None, until=None):
+        (self.since, self.until) = (since, until)
+        self.source = store.programmes(channels, since, until, self.channels)
+
+    # The XMLTV writer used by dump(). It renders the elements as strings
+    # (byte-identical to the SAX output of dump_sax()), with the attributes
+    # which repeat (channel, lang, system, ...), the timestamps and the icons
+    # memoized (bounded, so that the caches do not grow in a long running
+    # serve process).
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _xml_attr(name, value):
+        return " %s=%s" % (name, xml.sax.saxutils.quoteattr(value))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=8192)
+    def _xml_time(dt, tzinfo):
+        # tzinfo is part of the key because datetimes in different time zones
+        # compare equal
+        return '"%s"' % (dt.strftime("%Y%m%d%H%M%S %z"))
+
+    @staticmethod
+    def _xml_element(tag, attrs, text):
+        if text:
+            return "<%s%s>%s</%s>" % (
+                tag, attrs, xml.sax.saxutils.escape(text), tag)
+        return "<%s%s/>" % (tag, attrs)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _xml_icon(icon):
+        # icons whose URL cannot be parsed are skipped (as by dump_sax()). The
+        # attributes are not memoized by _xml_attr(), they rarely repeat.
+        quoteattr = xml.sax.saxutils.quoteattr
+        try:
+            urlparts = urllib.parse.urlparse(icon)
+            query_params = {
+                k: v
+                for (k, v) in (s.split("=", 2) for s in re.split("[&;]", urlparts.query))
+            }
+
+            icon_attrs = " src=%s" % (quoteattr(icon))
+            if "w" in query_params:
+                icon_attrs += " width=%s" % (quoteattr(query_params["w"]))
+            if "h" in query_params:
+                icon_attrs += " height=%s" % (quoteattr(query_params["h"]))
+            return "<icon%s/>" % (icon_attrs)
+        except (ValueError, TypeError, AttributeError):
+            # unparsable URL or query parameter, or not a str
+            return ""
+
+    def _xmltv_channel(self, channel):
+        attr = self._xml_attr
+        element = self._xml_element
+        return "".join((
+            "<channel", attr("id", channel.canonical_name), ">",
+            element("display-name", attr("lang", channel.language),
+                    channel.name),
+            element("display-name", "", "%u" % (channel.ordernum)),
+            "<icon", attr("src", channel.logo_url), "/>",
+            "</channel>"))
+
+    def _xmltv_programme(self, programme):
+        programme.decode()
+
+        attr = self._xml_attr
+        element = self._xml_element
+        escape = xml.sax.saxutils.escape
+
+        channel = programme.channel
+        (lower, upper) = programme.timeslot[:2]
+        lang = attr("lang", channel.language)  # assumption
+
+        parts = [
+            "<programme", attr("channel", channel.canonical_name),
+            " start=", self._xml_time(lower, lower.tzinfo),
+            " stop=", self._xml_time(upper, upper.tzinfo),
+            ">"]
+        n = len(parts)
+
+        if programme.title:
+            parts.append(element("title", lang, programme.title))
+        if programme.sub_title:
+            parts.append(element("sub-title", lang, programme.sub_title))
+        if programme.desc:
+            parts.append(element("desc", lang, programme.desc))
+
+        if programme.credits:
+            credits = "".join(
+                element(credit.position, "", credit.name)
+                for credit in programme.credits
+                if credit.position in self.CREDIT_POSITIONS)
+            parts.append(
+                ("<credits>%s</credits>" % (credits)) if credits
+                else "<credits/>")
+
+        if programme.date:
+            parts.append(element("date", "", str(programme.date)))
+
+        for category in programme.categories:
+            parts.append(element("category", lang, category))
+
+        for icon in programme.icons:
+            try:
+                icon = self._xml_icon(icon)
+            except TypeError:  # unhashable, i.e. not a URL
+                continue
+            if icon:
+                parts.append(icon)
+
+        if programme.country:
+            parts.append(element("country", "", programme.country))
 
+        if programme.episode_num:
+            parts.append(element(
+                "episode-num",
+                (attr("system", programme.episode_num_system)
+                 if programme.episode_num_system else ""),
+                programme.episode_num))
+
+        if programme.premiere:
+            parts.append("<premiere/>")
+
+        if programme.subtitles:
+            parts.append("<subtitles/>")
+
+        if programme.rating:
+            parts.append("<rating%s><value>%s</value></rating>" % (
+                (attr("system", programme.rating_system)
+                 if programme.rating_system else ""),
+                escape(programme.rating)))
+
+        if programme.star_rating:
+            parts.append("<star-rating><value>%s</value></star-rating>" % (
+                escape(programme.star_rating)))
+
+        if len(parts) == n:
+            parts[-1] = "/>"
+        else:
+            parts.append("</programme>")
+
+        return "".join(parts)
+
+    def _programmes(self):
+        # yields (channel, programme) for the programmes to dump, channel is
+        # None if it has already been yielded
+        since = self.since or datetime.datetime.now(datetime.timezone.utc)
+        until = self.until
+
+        dumped = set()  # pks
+        (past, later, n) = (0, 0, 0)
+
+        try:
+            for programme in self.source:
+                if programme.timeslot.lower < since:
+                    past += 1
+                    continue
+                if until and programme.timeslot.lower >= until:
+                    later += 1
+                    continue
+
+                n += 1
+                channel = programme.channel
+                if channel.pk not in dumped:
+                    dumped.add(channel.pk)
+                    yield (channel, programme)
+                else:
+                    yield (None, programme)
+        finally:
+            if self.stats is not None:
+                self.stats.count("programmes_skipped_past", past)
+                self.stats.count("programmes_skipped_until", later)
+                self.stats.count("programmes_dumped", n)
+
+    def _runs(self):
+        # groups the programmes of _programmes() into runs of programmes of
+        # the same channel and day, yields (channel, programmes), channel is
+        # None if it has already been yielded
+        def key(item):
+            programme = item[1]
+            return (programme.channel.pk, programme.timeslot.lower.date())
+
+        for (_, items) in itertools.groupby(self._programmes(), key):
+            items = list(items)
+            yield (items[0][0], [programme for (_, programme) in items])
+
+    @staticmethod
+    def _bytes_writer(fd):
+        # returns a function writing UTF-8 to fd
+        if not isinstance(fd, io.TextIOBase):
+            return fd.write
+        if getattr(fd, "buffer", None) is not None and \
+                "utf-8" == codecs.lookup(fd.encoding).name:
+            fd.flush()
+            return fd.buffer.write
+        return lambda data: fd.write(data.decode("utf-8"))
+
+    def _render_programmes(self, programmes):
+        for programme in programmes:
+            try:
+                yield self._xmltv_programme(programme)
+            except Exception as e:
+                raise ValueError("Failed to dump programme", programme) from e
+
+    def _render_fragment(self, channel, programmes):
+        # renders the programmes of a run (cf. _runs()) or copies them from
+        # the fragment cache
+        if len(programmes) < self.fragments.min_programmes:
+            return "".join(self._render_programmes(programmes)).encode(
+                "utf-8", "xmlcharrefreplace")
+
+        key = self.fragments.key(channel, programmes)
+        data = self.fragments.get(key)
+        if data is None:
+            data = "".join(self._render_programmes(programmes)).encode(
+                "utf-8", "xmlcharrefreplace")
+            self.fragments.put(key, data)
+        return data
+
+    def dump(self, fd=sys.stdout, bufsize=(1 << 16)):
+        write = self._bytes_writer(fd)
+
+        def encode(s):
+            return s.encode("utf-8", "xmlcharrefreplace")
+
+        buf = [
+            b'<?xml version="1.0" encoding="utf-8"?>\n',
+            b'<tv generator-info-name="tv7.py"',
+        ]
+        (size, empty) = (0, True)
+
+        if self.fragments is None:
+            runs = ((channel, (programme,))
+                    for (channel, programme) in self._programmes())
+        else:
+            runs = self._runs()
+
+        render_time = 0.0
+
+        for (channel, programmes) in runs:
+            t = time.perf_counter()
+            if empty:
+                buf.append(b">")
+                empty = False
+
+            if channel is not None:
+                try:
+                    buf.append(encode(self._xmltv_channel(channel)))
+                except Exception as e:
+                    raise ValueError("Failed to dump channel", channel) from e
+                size += len(buf[-1])
+
+            if self.fragments is None:
+                for s in self._render_programmes(programmes):
+                    buf.append(encode(s))
+                    size += len(buf[-1])
+            else:
+                buf.append(self._render_fragment(
+                    programmes[0].channel, programmes))
+                size += len(buf[-1])
+
+            render_time += time.perf_counter() - t
+
+            if size >= bufsize:
+                write(b"".join(buf))
+                buf.clear()
+                size = 0
+
+        buf.append(b"/>" if empty else b"</tv>")
+        write(b"".join(buf))
+        fd.flush()
+
+        if self.stats is not None:
+            self.stats.add_time("render", render_time)
+
+    def dump_sax(self, fd=sys.stdout):
         xmlgen = xml.sax.saxutils.XMLGenerator(
             fd, encoding="utf-8", short_empty_elements=True)
 
@@ -190,20 +516,17 @@ class XMLTVGenerator:
             "generator-info-name": "tv7.py"
         }))
 
-        for programme in self.source:
-            if programme.timeslot.lower < now:
-                continue
-
-            if programme.channel.pk not in self.channels:
+        for (channel, programme) in self._programmes():
+            if channel is not None:
                 try:
-                    self._dump_xmltv_channel(xmlgen, programme.channel)
-                    self.channels.add(programme.channel.pk)
-                except e:
-                    raise ValueError("Failed to dump channel", programme.channel) from e
+                    self._dump_xmltv_channel(xmlgen, channel)
+                except Exception as e:
+                    raise ValueError("Failed to dump channel", channel) from e
 
             try:
+                programme.decode()
                 self._dump_xmltv_programme(xmlgen, programme)
-            except e:
+            except Exception as e:
                 raise ValueError("Failed to dump programme", programme) from e
 
         xmlgen.endElement("tv")
@@ -217,8 +540,20 @@ class TV7EPGProgramme:
     Timeslot = collections.namedtuple("TV7EPGProgramme_Timeslot", (
         "lower", "upper", "bounds"))
 
+    # fromjson() only decodes pk, timeslot and channel (enough to filter the
+    # programmes), the values of the other fields are kept in a tuple and
+    # decoded on first access (cf. __getattr__()).
+    LAZY_FIELDS = (
+        "title", "sub_title", "desc", "categories", "country", "date",
+        "icons", "credits", "rating_system", "rating", "episode_num_system",
+        "episode_num", "premiere", "subtitles", "star_rating")
+    __slots__ = ("pk", "timeslot", "channel", "digest", "_raw") + LAZY_FIELDS
+
+    _get_raw = operator.itemgetter(*LAZY_FIELDS)
+    _get_credit = operator.itemgetter("position", "name")
+
     @classmethod
-    def fromjson(cls, json):
+    def fromjson(cls, json, channels=None):
         self = object.__new__(cls)
 
         self.pk = json["pk"]
@@ -226,43 +561,225 @@ class TV7EPGProgramme:
             datetime_from_iso(json["timeslot"]["lower"]),
             datetime_from_iso(json["timeslot"]["upper"]),
             json["timeslot"]["bounds"])
-        self.channel = TV7Channel.fromjson(json["channel"])
-        self.title = json["title"]
-        self.sub_title = json["sub_title"]
-        self.desc = json["desc"]
-        self.categories = json["categories"]
-        self.country = json["country"]
-        self.date = json["date"]
-        self.icons = json["icons"]
-        self.credits = [
-            cls.Credit(c["position"], c["name"])
-            for c in json["credits"]
-        ]
-        self.rating_system = json["rating_system"]
-        self.rating = json["rating"]
-        self.episode_num_system = json["episode_num_system"]
-        self.episode_num = json["episode_num"]
-        self.premiere = json["premiere"]
-        self.subtitles = json["subtitles"]
-        self.star_rating = json["star_rating"]
+        self.channel = (TV7Channel if channels is None else channels).fromjson(
+            json["channel"])
+        self.digest = None  # hash of the JSON text, if known
+        self._raw = cls._get_raw(json)
 
         return self
 
-    def str(self):
-        return json.dumps(vars(self), default=str)
+    def __getattr__(self, name):
+        # only called if the attribute has not been set (yet)
+        if name not in self.LAZY_FIELDS or self._raw is None:
+            raise AttributeError(name)
+        self.decode()
+        return object.__getattribute__(self, name)
+
+    def decode(self):
+        if self._raw is None:
+            return
+        (self.title, self.sub_title, self.desc, self.categories, self.country,
+         self.date, self.icons, credits, self.rating_system, self.rating,
+         self.episode_num_system, self.episode_num, self.premiere,
+         self.subtitles, self.star_rating) = self._raw
+        self.credits = [
+            tuple.__new__(self.Credit, self._get_credit(c))
+            for c in credits
+        ]
+        self._raw = None
+
+    def __str__(self):
+        return json.dumps({
+            k: getattr(self, k)
+            for k in ("pk", "timeslot", "channel") + self.LAZY_FIELDS
+        }, default=str)
 
-    def repr(self):
+    def __repr__(self):
         return str(self)
 
 
 class TV7EPG:
+    # The API does not filter by time, but returns the EPG ordered by start
+    # time, so that paging can stop once a page only contains programmes
+    # starting at or after until.
+
+    @staticmethod
+    def _stop_after(until):
+        if until is None:
+            return None
+        return lambda results: all(
+            datetime_from_iso(p["timeslot"]["lower"]) >= until
+            for p in results)
+
+    @classmethod
+    def allchannels(cls, api=None, until=None):
+        api = api or TV7API()
+        return map(api._programme_fromjson, api._paged_request(
+            "/epg/", cls._stop_after(until)))
+
     @classmethod
-    def allchannels(cls):
-        return map(TV7EPGProgramme.fromjson, TV7API()._paged_request("/epg/"))
+    def forchannel(cls, channel, api=None, until=None):
+        api = api or TV7API()
+        return map(api._programme_fromjson, api._paged_request(
+            "/epg/?channel=" + channel.pk, cls._stop_after(until)))
 
     @classmethod
-    def forchannel(cls, channel):
-        return map(TV7EPGProgramme.fromjson, TV7API()._paged_request("/epg/?channel=" + channel.pk))
+    def forchannels(cls, channels, api=None, until=None):
+        api = api or TV7API()
+        return map(api._programme_fromjson, api._paged_requests(
+            ("/epg/?channel=" + c.pk for c in channels),
+            cls._stop_after(until)))
+
+
+class TV7EPGStore:
+    """Local SQLite store of EPG programmes.
+
+    sync() fetches the EPG of the channels which are new, have changed (cf.
+    TV7Channel.changed) or have not been synced for a while, programmes()
+    returns the stored programmes of a time range.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS channel (
+            pk TEXT PRIMARY KEY,
+            ordernum INTEGER NOT NULL,
+            changed TEXT NOT NULL,
+            synced REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS programme (
+            pk TEXT PRIMARY KEY,
+            channel TEXT NOT NULL,
+            start INTEGER NOT NULL,
+            stop INTEGER NOT NULL,
+            json TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS programme_channel_start
+            ON programme (channel, start);
+    """
+
+    def __init__(self, path, stats=None):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self.SCHEMA)
+        self.stats = stats  # TV7Stats
+
+    def close(self):
+        self.db.close()
+
+    def sync(self, api, channels, max_age=datetime.timedelta(hours=12),
+             now=None, complete=False):
+        """Update the programmes of channels which start at or after now.
+
+        If complete is true, channels is the complete channel list and the
+        channels not in it are removed from the store.
+        Returns the number of channels fetched.
+        """
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        since = int(now.timestamp())
+        channels = list(channels)
+
+        stored = {
+            pk: (changed, synced)
+            for (pk, changed, synced) in self.db.execute(
+                "SELECT pk, changed, synced FROM channel")
+        }
+
+        def outdated(channel):
+            if channel.pk not in stored:
+                return True
+            (changed, synced) = stored[channel.pk]
+            return (changed != channel.changed.isoformat()
+                    or (since - synced) >= max_age.total_seconds())
+
+        fetch = [c for c in channels if outdated(c)]
+
+        with self.db:
+            if complete:
+                pks = [(pk,) for pk in stored.keys() - {c.pk for c in channels}]
+                self.db.executemany("DELETE FROM channel WHERE pk = ?", pks)
+                self.db.executemany(
+                    "DELETE FROM programme WHERE channel = ?", pks)
+            self.db.execute("DELETE FROM programme WHERE start < ?", (since,))
+
+        results = api._paged_request_lists(
+            "/epg/?channel=" + c.pk for c in fetch)
+        for (channel, programmes) in zip(fetch, results):
+            t = time.perf_counter()
+            rows = []
+            for p in programmes:
+                start = datetime_from_iso(p["timeslot"]["lower"]).timestamp()
+                if start < since:
+                    continue
+                stop = datetime_from_iso(p["timeslot"]["upper"]).timestamp()
+                rows.append((p["pk"], channel.pk, int(start), int(stop),
+                             json.dumps(p)))
+            if self.stats is not None:
+                self.stats.count(
+                    "programmes_skipped_past", len(programmes) - len(rows))
+
+            with self.db:
+                self.db.execute(
+                    "DELETE FROM programme WHERE channel = ?", (channel.pk,))
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO programme VALUES (?, ?, ?, ?, ?)",
+                    rows)
+                self.db.execute(
+                    "INSERT OR REPLACE INTO channel VALUES (?, ?, ?, ?)",
+                    (channel.pk, channel.ordernum,
+                     channel.changed.isoformat(), since))
+            if self.stats is not None:
+                self.stats.add_time("store", time.perf_counter() - t)
+
+        return len(fetch)
+
+    def programmes(self, channels=None, since=None, until=None,
+                   registry=None):
+        """Return the programmes (of channels, or all stored channels ordered
+        by their ordernum) starting in [since, until), per channel ordered
+        by start time.
+        """
+        if channels is None:
+            pks = [pk for (pk,) in self.db.execute(
+                "SELECT pk FROM channel ORDER BY ordernum, pk")]
+        else:
+            pks = [c.pk for c in channels]
+        since = int(since.timestamp()) if since else 0
+        until = int(until.timestamp()) if until else (1 << 62)
+
+        rows = itertools.chain.from_iterable(
+            self.db.execute(
+                "SELECT json FROM programme"
+                " WHERE channel = ? AND start >= ? AND start < ?"
+                " ORDER BY start", (pk, since, until))
+            for pk in pks)
+        for (j,) in rows:
+            if self.stats is None:
+                programme = TV7EPGProgramme.fromjson(json.loads(j), registry)
+            else:
+                t0 = time.perf_counter()
+                obj = json.loads(j)
+                t1 = time.perf_counter()
+                programme = TV7EPGProgramme.fromjson(obj, registry)
+                self.stats.parsed(time.perf_counter() - t1)
+                self.stats.add_time("json", t1 - t0)
+            programme.digest = hashlib.sha256(j.encode()).digest()
+            yield programme
+
+
+class TV7ChannelRegistry:
+    """TV7Channel objects by pk.
+
+    fromjson() returns the same object for every occurrence of a channel
+    (until its "changed" timestamp changes).
+    """
+
+    def __init__(self):
+        self._channels = {}  # pk -> (json["changed"], TV7Channel)
+
+    def fromjson(self, json):
+        entry = self._channels.get(json["pk"])
+        if entry is None or entry[0] != json["changed"]:
+            entry = (json["changed"], TV7Channel.fromjson(json))
+            self._channels[json["pk"]] = entry
+        return entry[1]
 
 
 class TV7Channel:
@@ -297,41 +814,577 @@ class TV7Channel:
         return TV7EPG.forchannel(self)
 
 
+class TV7Stats:
+    """Counters, time per stage and the latency histogram of the API requests
+    (cf. --stats and --metrics).
+
+    Stages: request (HTTP round trips, summed over the worker threads), json
+    (json.loads()), fromjson (TV7EPGProgramme.fromjson()), store (writes to
+    the TV7EPGStore) and render (XMLTV serialization).
+    """
+    COUNTERS = {
+        "requests": "HTTP requests sent",
+        "bytes": "bytes of HTTP response bodies received (as transferred)",
+        "cache_hits": "responses used from the HTTP cache without a request",
+        "not_modified": "cached responses revalidated (304 Not Modified)",
+        "pages": "API result pages processed",
+        "programmes_parsed": "programmes parsed (TV7EPGProgramme.fromjson())",
+        "programmes_skipped_past": "programmes skipped as past",
+        "programmes_skipped_until": "programmes skipped as after --days",
+        "programmes_dumped": "programmes written to the XMLTV output",
+    }
+    STAGES = ("request", "json", "fromjson", "store", "render")
+    LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.stages = dict.fromkeys(self.STAGES, 0.0)
+        self.channel_pages = collections.Counter()  # pk -> EPG pages
+        self.latency = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] += seconds
+
+    def parsed(self, seconds):
+        """Record a programme parsed (by fromjson()) in seconds."""
+        with self._lock:
+            self.stages["fromjson"] += seconds
+            self.counters["programmes_parsed"] += 1
+
+    def request(self, seconds):
+        """Record the round trip time of an API request."""
+        i = bisect.bisect_left(self.LATENCY_BUCKETS, seconds)
+        with self._lock:
+            self.stages["request"] += seconds
+            self.latency[i] += 1
+            self.latency_sum += seconds
+
+    def page(self, url):
+        """Record a result page of url."""
+        channel = urllib.parse.parse_qs(
+            urllib.parse.urlsplit(url).query).get("channel")
+        with self._lock:
+            self.counters["pages"] += 1
+            if channel:
+                self.channel_pages[channel[-1]] += 1
+
+    def asdict(self):
+        with self._lock:
+            return {
+                "timestamp": time.time(),
+                "duration": time.time() - self.started,
+                **self.counters,
+                "stages": dict(self.stages),
+                "channel_pages": dict(self.channel_pages),
+                "latency": {
+                    "buckets": dict(zip(
+                        [str(le) for le in self.LATENCY_BUCKETS] + ["+Inf"],
+                        itertools.accumulate(self.latency))),
+                    "sum": self.latency_sum,
+                    "count": sum(self.latency),
+                },
+            }
+
+    def prometheus(self):
+        """Return the stats in the Prometheus text format."""
+        d = self.asdict()
+        lines = []
+
+        def metric(name, mtype, help, samples):
+            lines.append("# HELP tv7_%s %s" % (name, help))
+            lines.append("# TYPE tv7_%s %s" % (name, mtype))
+            for (suffix, labels, value) in samples:
+                labels = ",".join(
+                    '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace(
+                        '"', '\\"')) for (k, v) in labels.items())
+                lines.append("tv7_%s%s%s %r" % (
+                    name, suffix, labels and "{%s}" % (labels), value))
+
+        metric("last_run_timestamp_seconds", "gauge",
+               "time the stats have been written", [("", {}, d["timestamp"])])
+        metric("duration_seconds", "gauge", "wall clock time",
+               [("", {}, d["duration"])])
+        for (name, help) in self.COUNTERS.items():
+            metric(name + "_total", "counter", help, [("", {}, d[name])])
+        metric("stage_seconds_total", "counter", "time spent per stage", [
+            ("", {"stage": stage}, t) for (stage, t) in d["stages"].items()])
+        metric("channel_pages_total", "counter", "EPG pages per channel", [
+            ("", {"channel": pk}, n)
+            for (pk, n) in sorted(d["channel_pages"].items())])
+        metric("request_duration_seconds", "histogram",
+               "round trip time of the API requests", [
+                   ("_bucket", {"le": le}, n)
+                   for (le, n) in d["latency"]["buckets"].items()] + [
+                   ("_sum", {}, d["latency"]["sum"]),
+                   ("_count", {}, d["latency"]["count"])])
+
+        return "".join(line + "\n" for line in lines)
+
+    def write(self, path):
+        """Write the stats to path (JSON if it ends with .json, Prometheus text
+        format otherwise), atomically (for the node_exporter textfile
+        collector).
+        """
+        if path.endswith(".json"):
+            data = json.dumps(self.asdict(), indent=2) + "\n"
+        else:
+            data = self.prometheus()
+        tmp = "%s.%u.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def summary(self):
+        """Return a human readable summary."""
+        d = self.asdict()
+        lines = ["%-24s %12.3f s" % ("duration", d["duration"])]
+        lines.extend("%-24s %12u" % (name, d[name]) for name in self.COUNTERS)
+        pages = d["channel_pages"].values()
+        if pages:
+            lines.append("%-24s %4u/%3.1f/%u" % (
+                "pages/channel min/avg/max", min(pages),
+                sum(pages) / len(pages), max(pages)))
+        if d["latency"]["count"]:
+            lines.append("%-24s %12.3f s" % (
+                "request latency (avg)",
+                d["latency"]["sum"] / d["latency"]["count"]))
+            lines.extend(
+                "%-24s %12u" % ("request latency <= " + le, n)
+                for (le, n) in d["latency"]["buckets"].items())
+        lines.extend("%-24s %12.3f s" % ("stage " + stage, t)
+                     for (stage, t) in d["stages"].items())
+        return "\n".join(lines)
+
+
+class HTTPConnectionPool:
+    """Persistent (keep-alive) HTTP(S) connections, per host.
+
+    The proxies of the environment (http_proxy, https_proxy, no_proxy) are
+    used like by urllib.request: HTTPS is tunneled (CONNECT), HTTP requests
+    are sent to the proxy.
+    """
+
+    def __init__(self, max_idle=4, timeout=60, stats=None):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.stats = stats
+        self.proxies = urllib.request.getproxies()
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _proxy(self, scheme, netloc):
+        # returns the proxy URL (urlsplit()) to use for scheme://netloc, or
+        # None
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.request.proxy_bypass(
+                urllib.parse.urlsplit("//" + netloc).hostname or netloc):
+            return None
+        if "://" not in proxy:
+            proxy = "http://" + proxy
+        return urllib.parse.urlsplit(proxy)
+
+    @staticmethod
+    def _proxy_headers(proxy):
+        if proxy.username is None:
+            return {}
+        credentials = "%s:%s" % (urllib.parse.unquote(proxy.username),
+                                 urllib.parse.unquote(proxy.password or ""))
+        return {"Proxy-Authorization": "Basic " + base64.b64encode(
+            credentials.encode()).decode("ascii")}
+
+    def _connect(self, scheme, netloc, proxy=None):
+        if scheme not in ("http", "https"):
+            raise ValueError("unsupported URL scheme: %s" % (scheme))
+
+        if proxy is None:
+            address = netloc
+        else:
+            address = "%s:%u" % (proxy.hostname, proxy.port or 80)
+
+        if "https" == scheme:
+            conn = http.client.HTTPSConnection(address, timeout=self.timeout)
+            if proxy is not None:
+                conn.set_tunnel(netloc, headers=self._proxy_headers(proxy))
+        else:
+            conn = http.client.HTTPConnection(address, timeout=self.timeout)
+        return conn
+
+    def _request(self, host, path, headers):
+        (scheme, netloc) = host
+        proxy = self._proxy(scheme, netloc)
+        if proxy is not None and "http" == scheme:
+            # the request is sent to the proxy
+            path = "http://%s%s" % (netloc, path)
+            headers = {**headers, **self._proxy_headers(proxy)}
+
+        with self._lock:
+            conn = self._idle[host].pop() if self._idle[host] else None
+
+        while True:
+            reused = conn is not None
+            if not reused:
+                conn = self._connect(scheme, netloc, proxy)
+
+            try:
+                conn.request("GET", path, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                conn.close()
+                if reused:
+                    # the server has closed the idle connection, try again
+                    conn = None
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+
+            if self.stats is not None:
+                self.stats.count("requests")
+                self.stats.count("bytes", len(body))
+            if "gzip" == resp.getheader("Content-Encoding"):
+                body = gzip.decompress(body)
+
+            if resp.will_close:
+                conn.close()
+            else:
+                with self._lock:
+                    if len(self._idle[host]) < self.max_idle:
+                        self._idle[host].append(conn)
+                        conn = None
+                if conn:
+                    conn.close()
+
+            return (resp, body)
+
+    def get(self, url, headers={}):
+        """GET url, returns (response, body), the body is gzip-decoded."""
+        headers = {
+            "Accept-Encoding": "gzip",
+            "User-Agent": "tv7.py",
+            **headers,
+        }
+
+        for _ in range(10):
+            urlparts = urllib.parse.urlsplit(url)
+            path = (urlparts.path or "/") + (
+                ("?" + urlparts.query) if urlparts.query else "")
+            (resp, body) = self._request(
+                (urlparts.scheme, urlparts.netloc), path, headers)
+
+            if resp.status in (301, 302, 303, 307, 308):
+                url = urllib.parse.urljoin(url, resp.getheader("Location"))
+                continue
+            if resp.status >= 400:
+                raise urllib.error.HTTPError(
+                    url, resp.status, resp.reason, resp.headers, None)
+            return (resp, body)
+
+        raise urllib.error.URLError("too many redirects: %s" % (url))
+
+    def close(self):
+        with self._lock:
+            for conn in itertools.chain.from_iterable(self._idle.values()):
+                conn.close()
+            self._idle.clear()
+
+
+class FileCache:
+    """Files in directory path, named by (hexadecimal) keys.
+
+    When the total size of the files exceeds max_size, the least recently
+    used files are removed (cf. trim()).
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def _read(self, key):
+        try:
+            with open(self._file(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            os.utime(self._file(key))  # mark as recently used
+        except OSError:
+            pass
+        return data
+
+    def _write(self, key, data):
+        path = self._file(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%u.%u.tmp" % (path, os.getpid(), threading.get_ident())
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def files(self):
+        try:
+            subdirs = [e for e in os.scandir(self.path) if e.is_dir()]
+        except FileNotFoundError:
+            return
+        for subdir in subdirs:
+            yield from os.scandir(subdir.path)
+
+    def trim(self):
+        """Remove the least recently used files until the cache fits into
+        max_size.
+        """
+        entries = sorted(
+            ((e.stat().st_mtime_ns, e.stat().st_size, e.path)
+             for e in self.files()), reverse=True)
+        size = sum(e[1] for e in entries)
+        while size > self.max_size and entries:
+            (_, file_size, path) = entries.pop()
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+
+    def clear(self):
+        for entry in self.files():
+            os.unlink(entry.path)
+
+
+class HTTPCache(FileCache):
+    """On-disk cache of HTTP responses, by URL.
+
+    Entries validated less than ttl seconds ago are used as they are, older
+    ones are revalidated (If-None-Match/If-Modified-Since).
+    """
+
+    def __init__(self, path, ttl=600, max_size=(64 << 20)):
+        super().__init__(path, max_size)
+        self.ttl = ttl
+
+    @staticmethod
+    def __key(url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def get(self, url):
+        """Return the cache entry of url (or None)."""
+        data = self._read(self.__key(url))
+        try:
+            entry = pickle.loads(data) if data else None
+        except (EOFError, pickle.UnpicklingError):
+            return None
+        if entry is None or entry.get("url") != url:
+            return None
+        return entry
+
+    def put(self, url, body, etag=None, last_modified=None):
+        """Store the response body of url (validated now)."""
+        entry = {
+            "url": url,
+            "body": body,
+            "etag": etag,
+            "last_modified": last_modified,
+            "validated": time.time(),
+        }
+        self._write(
+            self.__key(url), pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+        return entry
+
+    def fresh(self, entry):
+        return (time.time() - entry["validated"]) < self.ttl
+
+
+class XMLTVFragmentCache(FileCache):
+    """On-disk cache of rendered XMLTV fragments (the programmes of a channel
+    on a day), by a hash of the programmes' data.
+
+    Only used for the programmes of a TV7EPGStore: they are ordered by channel
+    and have digests. The programmes of the API are mostly interleaved (too
+    short runs) or would have to be decoded to compute the keys, which costs
+    about as much as rendering them.
+    """
+    VERSION = 1  # bump when the XMLTV output changes
+
+    def __init__(self, path, max_size, min_programmes=8):
+        super().__init__(path, max_size)
+        self.min_programmes = min_programmes  # smaller ones are not cached
+
+    def key(self, channel, programmes):
+        h = hashlib.sha256(repr(
+            (self.VERSION, channel.canonical_name, channel.language)).encode())
+        for programme in programmes:
+            if programme.digest is not None:
+                h.update(programme.digest)
+                continue
+            programme.decode()
+            h.update(repr((programme.pk, programme.timeslot) + tuple(
+                getattr(programme, k)
+                for k in TV7EPGProgramme.LAZY_FIELDS)).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        """Return the fragment (UTF-8) of key (or None)."""
+        return self._read(key)
+
+    def put(self, key, data):
+        self._write(key, data)
+
+
 class TV7API:
     api_bases = {
         1: "https://api.tv.init7.net/api",
         2: "https://tv7api2.tv.init7.net/api",
     }
 
-    def __init__(self, api_ver=1):
+    def __init__(self, api_ver=1, max_workers=4, cache=None, registry=None,
+                 stats=None):
         self.api_base = self.api_bases[api_ver]
+        self.max_workers = max_workers
+        self.cache = cache
+        self.registry = TV7ChannelRegistry() if registry is None else registry
+        self.stats = stats  # TV7Stats
+        self._executor = None
+        self._pool = HTTPConnectionPool(max_idle=max_workers, stats=stats)
+
+    def _submit(self, fn, *args):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                self.max_workers, thread_name_prefix="tv7api")
+        return self._executor.submit(fn, *args)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._pool.close()
+        if self.cache is not None:
+            self.cache.trim()
+
+    def _get(self, url):
+        headers = {"Accept": "application/json"}
+
+        entry = self.cache and self.cache.get(url)
+        if entry:
+            if self.cache.fresh(entry):
+                if self.stats is not None:
+                    self.stats.count("cache_hits")
+                return entry["body"]
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        t = time.perf_counter()
+        (resp, body) = self._pool.get(url, headers)
+        if self.stats is not None:
+            self.stats.request(time.perf_counter() - t)
+
+        if entry and 304 == resp.status:
+            body = entry["body"]
+            if self.stats is not None:
+                self.stats.count("not_modified")
+        elif 200 != resp.status:
+            raise urllib.error.HTTPError(
+                url, resp.status, resp.reason, resp.headers, None)
+
+        if self.cache is not None and \
+                "no-store" not in (resp.getheader("Cache-Control") or ""):
+            self.cache.put(
+                url, body,
+                resp.getheader("ETag") or (entry and entry["etag"]),
+                resp.getheader("Last-Modified") or (entry and entry["last_modified"]))
+
+        return body
+
+    def _fetch_block(self, url):
+        body = self._get(url)
+        if self.stats is None:
+            resp = json.loads(body)
+        else:
+            t = time.perf_counter()
+            resp = json.loads(body)
+            self.stats.add_time("json", time.perf_counter() - t)
+            self.stats.page(url)
 
-    def _paged_request(self, route):
-        def _fetch_block(url):
-            req = urllib.request.urlopen(url)
-            resp = json.loads(req.read())
-
-            results = resp.get("results", [])
-            next_url = resp.get("next", None)
-            return (results, next_url)
+        results = resp.get("results", [])
+        next_url = resp.get("next", None)
+        return (results, next_url)
 
+    def _fetch_all(self, route, stop=None):
+        results = []
         next_url = self.api_base + route
         while next_url:
-            (results, next_url) = _fetch_block(next_url)
+            (block, next_url) = self._fetch_block(next_url)
+            results.extend(block)
+            if stop and stop(block):
+                break
+        return results
+
+    def _paged_request(self, route, stop=None):
+        # the next page is fetched in the background while the current one is
+        # being consumed. Paging ends early if stop(results of a page) is true.
+        future = self._submit(self._fetch_block, self.api_base + route)
+        while future:
+            (results, next_url) = future.result()
+            if stop and stop(results):
+                next_url = None
+            future = next_url and self._submit(self._fetch_block, next_url)
             yield from results
 
+    def _paged_requests(self, routes, stop=None):
+        # like _paged_request() for multiple routes, up to max_workers routes
+        # are fetched concurrently, the results are returned in order of routes
+        return itertools.chain.from_iterable(
+            self._paged_request_lists(routes, stop))
+
+    def _paged_request_lists(self, routes, stop=None):
+        # like _paged_requests(), but yields a list of results per route
+        routes = iter(routes)
+        pending = collections.deque(
+            self._submit(self._fetch_all, r, stop)
+            for r in itertools.islice(routes, self.max_workers))
+        while pending:
+            results = pending.popleft().result()
+            for r in itertools.islice(routes, 1):
+                pending.append(self._submit(self._fetch_all, r, stop))
+            yield results
+
+    def _programme_fromjson(self, json):
+        if self.stats is None:
+            return TV7EPGProgramme.fromjson(json, self.registry)
+        t = time.perf_counter()
+        programme = TV7EPGProgramme.fromjson(json, self.registry)
+        self.stats.parsed(time.perf_counter() - t)
+        return programme
+
     def channels(self):
-        return map(TV7Channel.fromjson, self._paged_request("/tvchannel/"))
+        return map(self.registry.fromjson, self._paged_request("/tvchannel/"))
+
+    def channels_by_name(self, names):
+        # look up the channels concurrently (in order of names)
+        return map(concurrent.futures.Future.result, [
+            self._submit(self.channel_by_name, name) for name in names])
 
     def channel_by_name(self, name):
-        results = list(self._paged_request(
-            "/tvchannel/?canonical_name=" + urllib.parse.quote(name)))
+        results = self._fetch_all(
+            "/tvchannel/?canonical_name=" + urllib.parse.quote(name))
         assert len(results) == 1, ("no channel %s" % (name))
-        return TV7Channel.fromjson(results[0])
+        return self.registry.fromjson(results[0])
 
 
-def generate_channel_m3u(url_type="mcast", extra=False):
-    channels = TV7API().channels()
+def generate_channel_m3u(url_type="mcast", extra=False, api=None,
+                         channels=None):
+    if channels is None:
+        channels = (api or TV7API()).channels()
 
     yield "#EXTM3U"
     for ch in sorted(channels, key=lambda c: c.ordernum):
@@ -356,12 +1409,296 @@ def generate_channel_m3u(url_type="mcast", extra=False):
         yield getattr(ch, url_type+"_src")
 
 
+class TV7Guide:
+    """The channels and EPG kept in memory (for the serve command).
+
+    refresh() fetches them (or syncs the store and loads them from it) and
+    renders the XMLTV document, xmltv() and m3u() return the documents of the
+    current state (rendered on first use and kept until the next refresh).
+    """
+    MAX_DOCUMENTS = 32  # per refresh
+
+    def __init__(self, api, names=None, days=None, store_path=None,
+                 store_max_age=datetime.timedelta(hours=12), fragments=None):
+        self.api = api
+        self.names = names
+        self.days = days
+        self.store_path = store_path
+        self.store_max_age = store_max_age
+        # (fragments are only cached for the store, cf. XMLTVFragmentCache)
+        self.fragments = fragments if store_path else None
+
+        self.channels = []
+        self.programmes = []
+        self.updated = None
+        self._store = None  # opened by the thread calling refresh()
+        self._documents = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def refresh(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        channels = list(self.api.channels())
+        if self.names:
+            by_name = {c.canonical_name: c for c in channels}
+            selected = [by_name[name] for name in self.names]
+        else:
+            selected = None
+        until = days_after(now, self.days)
+
+        if self.store_path:
+            if self._store is None:
+                self._store = TV7EPGStore(self.store_path, self.api.stats)
+            self._store.sync(
+                self.api, selected or channels, self.store_max_age, now,
+                complete=(selected is None))
+            programmes = self._store.programmes(
+                selected, now, until, self.api.registry)
+        elif selected:
+            programmes = TV7EPG.forchannels(selected, self.api, until)
+        else:
+            programmes = TV7EPG.allchannels(self.api, until)
+
+        programmes = list(programmes)
+        for programme in programmes:
+            programme.decode()  # not thread-safe, do it before serving
+
+        document = self._render_xmltv(programmes, now, until)
+        with self._lock:
+            (self.channels, self.programmes) = (channels, programmes)
+            self.updated = now
+            self._documents = {("xmltv", (), None): document}
+        self._ready.set()
+
+        if self.fragments is not None:
+            self.fragments.trim()
+
+    def wait(self, timeout=None):
+        """Wait for the first refresh(), return whether it has finished."""
+        return self._ready.wait(timeout)
+
+    def _render_xmltv(self, programmes, since, until, names=None):
+        xmltvgen = XMLTVGenerator(
+            self.api.registry, self.fragments, self.api.stats)
+        (xmltvgen.since, xmltvgen.until) = (since, until)
+        if names:
+            names = set(names)
+            programmes = (p for p in programmes
+                          if p.channel.canonical_name in names)
+        xmltvgen.source = programmes
+
+        buf = io.BytesIO()
+        xmltvgen.dump(buf)
+        return buf.getvalue()
+
+    def _document(self, key, render):
+        with self._lock:
+            document = self._documents.get(key)
+            if document is None:
+                if len(self._documents) >= self.MAX_DOCUMENTS:
+                    self._documents.clear()
+                document = self._documents[key] = render()
+            return document
+
+    def xmltv(self, names=None, days=None):
+        """Return the XMLTV document (UTF-8) of the programmes (of the
+        channels names) starting since the last refresh (and within days).
+        """
+        return self._document(
+            ("xmltv", tuple(names or ()), days),
+            lambda: self._render_xmltv(
+                self.programmes, self.updated,
+                days_after(self.updated, self.days if days is None else days),
+                names))
+
+    def m3u(self, url_type="hls", extra=False):
+        """Return the M3U playlist (UTF-8) of all channels."""
+        return self._document(
+            ("m3u", url_type, extra),
+            lambda: "".join(
+                line + "\n" for line in generate_channel_m3u(
+                    url_type, extra, channels=self.channels)).encode("utf-8"))
+
+
+class TV7RequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the documents of server.guide:
+
+    GET /xmltv[?channel=NAME...][&days=N]
+    GET /m3u[?type=hls|mcast][&extra]
+    GET /metrics (TV7Stats in the Prometheus text format)
+    """
+    server_version = "tv7.py"
+    ready_timeout = 30  # seconds to wait for the first refresh
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return "unix"
+
+    def do_GET(self):
+        self._respond()
+
+    def do_HEAD(self):
+        self._respond(head=True)
+
+    def _respond(self, head=False):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        guide = self.server.guide
+
+        if "/xmltv" == url.path:
+            try:
+                days = (parse_days(query["days"][-1]) if "days" in query
+                        else None)
+            except ValueError:
+                self.send_error(400, "Invalid days")
+                return
+            content_type = "application/xml; charset=utf-8"
+            render = functools.partial(guide.xmltv, query.get("channel"), days)
+        elif "/m3u" == url.path:
+            url_type = query.get("type", ["hls"])[-1]
+            if url_type not in ("hls", "mcast"):
+                self.send_error(400, "Invalid type")
+                return
+            content_type = "audio/x-mpegurl; charset=utf-8"
+            render = functools.partial(guide.m3u, url_type, "extra" in query)
+        elif "/metrics" == url.path and guide.api.stats is not None:
+            # (does not wait for the first refresh)
+            self._send(
+                guide.api.stats.prometheus().encode("utf-8"),
+                "text/plain; version=0.0.4; charset=utf-8", head=head)
+            return
+        else:
+            self.send_error(404)
+            return
+
+        if not guide.wait(self.ready_timeout):
+            self.send_error(503, "EPG not loaded yet")
+            return
+        body = render()
+        self._send(body, content_type, guide.updated, head)
+
+    def _send(self, body, content_type, last_modified=None, head=False):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if last_modified is not None:
+            self.send_header("Last-Modified", email.utils.format_datetime(
+                last_modified, usegmt=True))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+
+class TV7HTTPServer(http.server.ThreadingHTTPServer):
+    def __init__(self, address, guide):
+        super().__init__(address, TV7RequestHandler)
+        self.guide = guide
+
+
+class TV7UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, guide):
+        super().__init__(path, TV7RequestHandler)
+        self.guide = guide
+
+
+def serve(guide, listen, interval, retry_interval=300):
+    """Serve guide on listen (HOST:PORT, PORT or the path of a Unix socket)
+    and refresh it every interval seconds in the background (SIGHUP refreshes
+    it immediately).
+    """
+    refresh_now = threading.Event()
+
+    def refresh():
+        while True:
+            try:
+                guide.refresh()
+                timeout = interval
+            except Exception:
+                traceback.print_exc()
+                timeout = min(interval, retry_interval)
+            refresh_now.wait(timeout)
+            refresh_now.clear()
+
+    if "/" in listen:
+        if os.path.exists(listen) and stat.S_ISSOCK(os.stat(listen).st_mode):
+            import socket
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(listen)
+                except ConnectionRefusedError:
+                    os.unlink(listen)  # stale
+                # else: in use, binding fails below
+        server = TV7UnixHTTPServer(listen, guide)
+    else:
+        (host, _, port) = listen.rpartition(":")
+        server = TV7HTTPServer((host or "127.0.0.1", int(port)), guide)
+
+    signal.signal(signal.SIGHUP, lambda signum, frame: refresh_now.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    threading.Thread(target=refresh, name="refresh", daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if "/" in listen:
+            os.unlink(listen)
+
+
 if __name__ == "__main__":
     import argparse
 
+    def days_type(s):
+        try:
+            return parse_days(s)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                "not a finite, non-negative number: %r" % (s))
+
+    def datetime_type(s):
+        try:
+            dt = datetime_from_iso(s)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                "not an ISO 8601 date/time: %r" % (s))
+        if dt.tzinfo is None:
+            dt = dt.astimezone()  # local time
+        return dt
+
     parser = argparse.ArgumentParser(
         prog="tv7.py",
         epilog="This program is not endorsed by Init7 (yet :D).")
+    parser.add_argument(
+        "--cache-dir", default=os.path.join(
+            os.environ.get("XDG_CACHE_HOME") or
+            os.path.join(os.path.expanduser("~"), ".cache"),
+            "tv7"),
+        help="directory of the HTTP and XMLTV fragment caches (default: "
+        "%(default)s)")
+    parser.add_argument(
+        "--cache-ttl", type=int, default=600, metavar="SECONDS",
+        help="use cached responses without revalidating them for SECONDS "
+        "(default: %(default)s)")
+    parser.add_argument(
+        "--cache-size", type=int, default=64, metavar="MB",
+        help="maximum size of each cache (default: %(default)s)")
+    parser.add_argument(
+        "--no-cache", action="store_true", default=False,
+        help="do not use the caches")
+    parser.add_argument(
+        "--clear-cache", action="store_true", default=False,
+        help="remove all cached responses and fragments before running")
+    parser.add_argument(
+        "--stats", action="store_true", default=False,
+        help="print request, programme and timing statistics to stderr")
+    parser.add_argument(
+        "--metrics", metavar="FILE",
+        help="write the statistics to FILE (JSON if it ends with .json, "
+        "Prometheus text format otherwise)")
     subparsers = parser.add_subparsers(dest="command", required=True)
 
     parser_m3u = subparsers.add_parser("m3u", help="M3U playlist generator")
@@ -370,12 +1707,71 @@ if __name__ == "__main__":
 
     parser_xmltv = subparsers.add_parser("xmltv", help="XMLTV generator")
     parser_xmltv.add_argument("-o", type=str, dest="ofile", default="-")
+    parser_xmltv.add_argument(
+        "-j", "--jobs", type=int, default=4,
+        help="number of concurrent API requests (default: 4)")
+    parser_xmltv.add_argument(
+        "--from", type=datetime_type, dest="since", metavar="DATETIME",
+        help="only include programmes starting at or after DATETIME (ISO "
+        "8601, local time if no offset is given; default: now)")
+    parser_xmltv.add_argument(
+        "--days", type=days_type, metavar="N",
+        help="only include programmes starting within N days")
+    parser_xmltv.add_argument(
+        "--store", metavar="FILE",
+        help="keep the EPG in the SQLite database FILE and only fetch the "
+        "channels which are new or outdated")
+    parser_xmltv.add_argument(
+        "--store-max-age", type=float, default=12, metavar="HOURS",
+        help="fetch the EPG of channels synced more than HOURS ago again "
+        "(default: %(default)s)")
     parser_xmltv.add_argument("channels", type=str, nargs="*")
 
+    parser_serve = subparsers.add_parser(
+        "serve", help="XMLTV and M3U server (EPG kept in memory)")
+    parser_serve.add_argument(
+        "--listen", default="127.0.0.1:7707", metavar="ADDRESS",
+        help="HOST:PORT, PORT or path of a Unix socket to serve HTTP on "
+        "(default: %(default)s)")
+    parser_serve.add_argument(
+        "--refresh", type=float, default=60, metavar="MINUTES",
+        help="refresh the EPG every MINUTES (default: %(default)s)")
+    parser_serve.add_argument(
+        "-j", "--jobs", type=int, default=4,
+        help="number of concurrent API requests (default: 4)")
+    parser_serve.add_argument(
+        "--days", type=days_type, metavar="N",
+        help="only keep programmes starting within N days")
+    parser_serve.add_argument(
+        "--store", metavar="FILE",
+        help="keep the EPG in the SQLite database FILE and only fetch the "
+        "channels which are new or outdated")
+    parser_serve.add_argument(
+        "--store-max-age", type=float, default=12, metavar="HOURS",
+        help="fetch the EPG of channels synced more than HOURS ago again "
+        "(default: %(default)s)")
+    parser_serve.add_argument("channels", type=str, nargs="*")
+
     options = parser.parse_args()
 
+    cache = HTTPCache(
+        os.path.join(options.cache_dir, "http"), options.cache_ttl,
+        (options.cache_size << 20))
+    fragments = XMLTVFragmentCache(
+        os.path.join(options.cache_dir, "xmltv"), (options.cache_size << 20))
+    if options.clear_cache:
+        cache.clear()
+        fragments.clear()
+    if options.no_cache:
+        (cache, fragments) = (None, None)
+    if options.stats or options.metrics or "serve" == options.command:
+        stats = TV7Stats()
+    else:
+        stats = None
+
     if "m3u" == options.command:
-        kwargs = {"url_type": options.type, "extra": options.extra}
+        api = TV7API(cache=cache, stats=stats)
+        kwargs = {"url_type": options.type, "extra": options.extra, "api": api}
         print(*generate_channel_m3u(**kwargs), sep="\n")
     elif "xmltv" == options.command:
         if "-" == options.ofile:
@@ -388,11 +1784,44 @@ if __name__ == "__main__":
         else:
             dest = open(options.ofile, "w")
 
+        api = TV7API(max_workers=options.jobs, cache=cache, stats=stats)
         if options.channels:
-            channels = map(TV7API().channel_by_name, options.channels)
+            channels = api.channels_by_name(options.channels)
         else:
             channels = None
 
-        xmltvgen = XMLTVGenerator()
-        xmltvgen.fromtv7epg(channels)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        since = options.since
+        until = days_after(since or now, options.days)
+
+        # (fragments are only cached for the store, cf. XMLTVFragmentCache)
+        xmltvgen = XMLTVGenerator(
+            api.registry, (fragments if options.store else None), stats)
+        if options.store:
+            store = TV7EPGStore(options.store, stats)
+            if channels is not None:
+                channels = list(channels)
+            store.sync(
+                api, channels or api.channels(),
+                datetime.timedelta(hours=options.store_max_age), now,
+                complete=(channels is None))
+            xmltvgen.fromstore(store, channels, since or now, until)
+        else:
+            xmltvgen.fromtv7epg(channels, api, since, until)
         xmltvgen.dump(dest)
+
+        if fragments is not None:
+            fragments.trim()
+    elif "serve" == options.command:
+        api = TV7API(max_workers=options.jobs, cache=cache, stats=stats)
+        guide = TV7Guide(
+            api, options.channels, options.days, options.store,
+            datetime.timedelta(hours=options.store_max_age), fragments)
+        serve(guide, options.listen, options.refresh * 60)
+
+    api.close()
+
+    if options.stats:
+        print(stats.summary(), file=sys.stderr)
+    if options.metrics:
+        stats.write(options.metrics)